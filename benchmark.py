@@ -0,0 +1,171 @@
+# scripts/benchmark.py
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# --- CẤU HÌNH ---
+RESULTS_DIR = 'bench_results'
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- CÁC STAGE (chạy với cwd = thư mục dữ liệu giả lập, đường dẫn mặc định của script) ---
+
+def stage_preprocess():
+    import pre_process
+    pre_process.preprocess_mirtarbase(pre_process.MI_RTARBASE_RAW_PATH, pre_process.MI_RTARBASE_PROCESSED_PATH)
+    fam_map = pre_process.load_family_mapping(pre_process.FAMILY_INFO_PATH)
+    pre_process.preprocess_targetscan(pre_process.TARGETSCAN_RAW_PATH, pre_process.TARGETSCAN_PROCESSED_PATH, fam_map)
+
+def stage_merge():
+    import merge_mirna_expression as m
+    m.merge_mirna_files(m.DOWNLOADED_FILES_DIR, m.MANIFEST_FILE_PATH, m.METADATA_FILE_PATH, m.OUTPUT_MATRIX_PATH,
+                        incremental=False)
+
+def stage_build_edges():
+    import build_mirna_gene_edges
+    build_mirna_gene_edges.build_edges(use_cache=False) # Đo phần tính tương quan, không phải cache hit
+
+def stage_ensembl():
+    import pandas as pd
+    import ensemble_transfer
+    from gene_resolver import GeneSymbolResolver, load_hgnc_dump
+    from remote_lookup import AsyncBatchBackend, MyGeneClient, fake_mygene_server
+    db_path = 'data/reference/bench_gene_symbols.sqlite'
+    checkpoint_path = 'data/cache/bench_mygene_checkpoint.jsonl'
+    for path in (db_path, checkpoint_path): # Mỗi vòng đều phải đi qua đường remote
+        if os.path.exists(path):
+            os.remove(path)
+    load_hgnc_dump('data/raw/hgnc_complete_set.txt', db_path)
+    # Không gọi mạng: symbol thiếu trong dump được trả lời bởi fake MyGene server cục bộ (HTTP, async theo lô)
+    symbols = pd.read_csv('data/raw/hgnc_complete_set.txt', sep='\t', usecols=['symbol'], dtype=str)['symbol']
+    mapping = {s: f'ENSGFAKE{i:08d}' for i, s in enumerate(symbols)}
+    with fake_mygene_server(mapping) as url:
+        remote = AsyncBatchBackend(MyGeneClient(base_url=url), checkpoint_path=checkpoint_path)
+        resolver = GeneSymbolResolver(db_path, remote=remote, manual_map=ensemble_transfer.MANUAL_CORRECTION_MAP)
+        ensemble_transfer.convert_edge_file_to_ensembl(ensemble_transfer.INPUT_EDGES_PATH, ensemble_transfer.OUTPUT_EDGES_PATH,
+                                                       resolver=resolver)
+
+STAGES = {
+    'preprocess_interactions': stage_preprocess,
+    'merge_mirna_files': stage_merge,
+    'build_edges': stage_build_edges,
+    'convert_edge_file_to_ensembl': stage_ensembl,
+}
+
+def _run_stage(name, data_dir, queue):
+    """Chạy trong process riêng (spawn) -> peak RSS chỉ của stage này."""
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(data_dir)
+    import numpy, pandas # Nạp thư viện trước để tách RSS nền khỏi RSS của stage
+    import instrumentation as ins
+    baseline = ins.rss_mb('VmRSS')
+    start = time.perf_counter()
+    error = None
+    try:
+        # Báo cáo chi tiết theo phase: data/reports/<stage>.json. Peak của stage = peak của phase 'total'
+        # (đã gộp peak các phase con; VmHWM bị đặt lại ở mỗi phase nên đọc sau stage chỉ thấy phase cuối)
+        with ins.stage(name) as recorder:
+            STAGES[name]()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    queue.put({'stage': name, 'seconds': round(time.perf_counter() - start, 3),
+               'peak_rss_mb': recorder.phases['total']['peak_rss_mb'], 'baseline_rss_mb': round(baseline, 1), 'error': error,
+               'phases': recorder.phases, 'rows': recorder.rows})
+
+def run_stage(name, data_dir):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_stage, args=(name, data_dir, queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        return {'stage': name, 'seconds': None, 'peak_rss_mb': None, 'baseline_rss_mb': None,
+                'error': f"process exited with code {proc.exitcode}"}
+    return queue.get()
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run_benchmark(data_dir, preset, stages, repeat=1, seed=0, regenerate=False):
+    from synthetic_data import PRESETS, generate
+    if regenerate or not os.path.exists(os.path.join(data_dir, 'data', 'features', 'genes_expr.txt')):
+        os.makedirs(data_dir, exist_ok=True)
+        start = time.perf_counter()
+        generate(data_dir, seed=seed, **PRESETS[preset])
+        logging.info(f"Data generated in {time.perf_counter() - start:.1f}s")
+
+    results = []
+    for round_no in range(repeat):
+        for name in stages:
+            logging.info(f"[round {round_no + 1}/{repeat}] {name}...")
+            result = run_stage(name, os.path.abspath(data_dir))
+            result['round'] = round_no + 1
+            results.append(result)
+            logging.info(f"   > {result['seconds']}s, peak RSS {result['peak_rss_mb']} MB" +
+                         (f", ERROR {result['error']}" if result['error'] else ""))
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'preset': preset,
+        'sizes': PRESETS[preset],
+        'seed': seed,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+
+def compare(old_path, new_path):
+    """In tỉ lệ thời gian / bộ nhớ giữa 2 file kết quả (trung bình theo stage)."""
+    def summarize(path):
+        with open(path) as f:
+            report = json.load(f)
+        summary = {}
+        for r in report['results']:
+            if r['seconds'] is not None:
+                summary.setdefault(r['stage'], []).append((r['seconds'], r['peak_rss_mb']))
+        return report.get('commit'), {k: (sum(s for s, _ in v) / len(v), max(m for _, m in v)) for k, v in summary.items()}
+
+    old_commit, old = summarize(old_path)
+    new_commit, new = summarize(new_path)
+    print(f"{'stage':32s} {old_commit or 'old':>12s} {new_commit or 'new':>12s} {'time x':>8s} {'rss x':>8s}")
+    for stage in old.keys() & new.keys():
+        (t0, m0), (t1, m1) = old[stage], new[stage]
+        print(f"{stage:32s} {t0:11.2f}s {t1:11.2f}s {t1 / t0 if t0 else float('nan'):8.2f} {m1 / m0 if m0 else float('nan'):8.2f}")
+
+if __name__ == "__main__":
+    from synthetic_data import PRESETS
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data (offline).")
+    parser.add_argument('--preset', default='small', choices=sorted(PRESETS))
+    parser.add_argument('--data-dir', default=None, help="Where synthetic inputs live (default: bench_data/<preset>)")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--output', default=None, help="JSON output (default: bench_results/<commit>-<preset>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD_JSON', 'NEW_JSON'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    data_dir = args.data_dir or os.path.join('bench_data', args.preset)
+    report = run_benchmark(data_dir, args.preset, args.stages, args.repeat, args.seed, args.regenerate)
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit'] or 'nocommit'}-{args.preset}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Benchmark results saved to {output}")
@@ -0,0 +1,102 @@
+# scripts/build_cohort_edges.py
+import pandas as pd
+import os
+import sys
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import build_mirna_gene_edges as edges
+from edge_writer import metadata_path_for
+from correlation_cache import prune_cache, CACHE_KEEP
+import instrumentation as ins
+
+# --- CẤU HÌNH ---
+# Danh sách cohort (JSON): [{"name": "TCGA-LIHC", "patients": [...] hoặc "file_barcode.txt",
+#                           "gene_path": ..., "mir_path": ...}, ...]
+# Thiếu patients -> mọi bệnh nhân chung; thiếu gene_path / mir_path -> dùng ma trận của build_edges
+COHORTS_PATH = 'data/cohorts.json'
+COHORT_OUTPUT_DIR = 'data/edges/cohorts' # <name>.csv cho mỗi cohort + summary.tsv
+N_COHORT_WORKERS = 4 # Số cohort chạy song song (mỗi cohort tính tương quan trong 1 process)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+# Bảng ứng viên dùng chung, nạp 1 lần ở process chính (fork -> worker đọc lại không tốn copy)
+_candidates = None
+
+def load_cohorts(path=COHORTS_PATH):
+    """Đọc danh sách cohort, patients dạng file -> list barcode (mỗi dòng 1 barcode)."""
+    with open(path) as f:
+        cohorts = json.load(f)
+    names = [c['name'] for c in cohorts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate cohort names in {path}")
+    for cohort in cohorts:
+        if isinstance(cohort.get('patients'), str):
+            with open(cohort['patients']) as f:
+                cohort['patients'] = [line.strip() for line in f if line.strip()]
+    return cohorts
+
+def _init_worker(candidates):
+    global _candidates
+    _candidates = candidates
+
+def run_cohort(cohort, output_dir=COHORT_OUTPUT_DIR):
+    """
+    Tính + ghi cạnh cho một cohort, trả về dòng tóm tắt (status = ok / empty / failed).
+    File cạnh cũ của cohort bị xóa trước -> cohort lỗi không để lại kết quả của lần chạy trước.
+    """
+    name = cohort['name']
+    output_path = os.path.join(output_dir, f"{name}.csv")
+    row = {'cohort': name, 'status': 'failed', 'patients': 0, 'candidate_pairs': 0, 'edges': 0,
+           'cached': False, 'seconds': 0.0, 'output': output_path}
+    start = time.perf_counter()
+    for path in (output_path, metadata_path_for(output_path)):
+        if os.path.exists(path):
+            os.remove(path)
+    with ins.stage(f'cohort_{name}'):
+        try:
+            summary = edges.edges_for_patients(cohort.get('gene_path', edges.GENE_PATH), cohort.get('mir_path', edges.MIR_PATH),
+                                               output_path, patients=cohort.get('patients'), candidates=_candidates, n_workers=1,
+                                               prune_cache=False)
+            if summary is not None:
+                row.update(summary, status='ok' if summary['edges'] else 'empty')
+        except Exception as e:
+            ins.error('build_edges', e)
+            logging.error(f"Cohort {name} failed: {e}")
+    row['seconds'] = round(time.perf_counter() - start, 2)
+    return row
+
+def build_cohort_edges(cohorts, output_dir=COHORT_OUTPUT_DIR, n_workers=N_COHORT_WORKERS):
+    """Nạp ứng viên 1 lần rồi chia cohort cho các process; ghi summary.tsv (thứ tự như danh sách cohort)."""
+    candidates = edges.load_candidates()
+    logging.info(f"Loaded {len(candidates)} shared candidate pairs; building {len(cohorts)} cohorts...")
+
+    rows = {}
+    if n_workers > 1 and len(cohorts) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(cohorts)), initializer=_init_worker, initargs=(candidates,)) as pool:
+            futures = {pool.submit(run_cohort, cohort, output_dir): cohort['name'] for cohort in cohorts}
+            for future in as_completed(futures):
+                rows[futures[future]] = row = future.result()
+                logging.info(f"[{row['cohort']}] {row['status']}: {row['edges']} edges, {row['patients']} patients ({row['seconds']}s)")
+    else:
+        _init_worker(candidates)
+        for cohort in cohorts:
+            rows[cohort['name']] = run_cohort(cohort, output_dir)
+
+    # Dọn cache một lần, giữ đủ cho mọi cohort -> quét ngưỡng lần sau vẫn dùng cache
+    prune_cache(max(CACHE_KEEP, len(cohorts)))
+
+    summary = pd.DataFrame([rows[cohort['name']] for cohort in cohorts])
+    os.makedirs(output_dir, exist_ok=True)
+    summary.to_csv(os.path.join(output_dir, 'summary.tsv'), sep='\t', index=False)
+    logging.info(f"SUCCESS: {(summary['status'] == 'ok').sum()} / {len(summary)} cohorts, summary saved to {os.path.join(output_dir, 'summary.tsv')}")
+    return summary
+
+if __name__ == "__main__":
+    # python build_cohort_edges.py [cohorts.json]
+    try:
+        build_cohort_edges(load_cohorts(sys.argv[1] if len(sys.argv) > 1 else COHORTS_PATH))
+    except Exception as e:
+        logging.error(f"Batch failed: {e}")
\ No newline at end of file
@@ -1,9 +1,14 @@
 import pandas as pd
-from scipy.stats import pearsonr
-from tqdm import tqdm
-import os
+import numpy as np
 import logging
-import re
+
+from expression_store import read_expression_header, read_patient_matrix, patient_barcode
+from mirna_ids import load_id_index
+from correlation_engine import correlate_candidates_parallel, permutation_qvalues, pair_qvalues, transform_rows, ASSOCIATIONS, SHARD_SIZE
+from correlation_cache import cache_key, load_results, save_results
+from edge_writer import EdgeWriter, EDGE_CHUNK_ROWS
+from ensemble_transfer import convert_symbols_to_ensembl_with_fallback
+import instrumentation as ins
 
 # --- CONFIG ---
 GENE_PATH = 'data/features/genes_expr.txt'
@@ -16,103 +21,189 @@ P_THRESH = 0.05
 R_THRESH = -0.1 # Tương quan nghịch
 BONUS = 0.1
 
+N_WORKERS = 1 # > 1: chia shard theo precursor cho nhiều process
+
+# Thước đo liên hệ: 'pearson', 'spearman' (hạng, bền với dữ liệu RPM đuôi dài),
+# 'log_pearson' (log2(x + 1) rồi Pearson). Ghi kèm file cạnh trong <output>.meta.json
+ASSOCIATION = 'pearson'
+
+# Kiểm định: 'pearson' = p tham số chưa hiệu chỉnh (mặc định cũ),
+# 'pearson_fdr' = BH trên p tham số, 'permutation_fdr' = p hoán vị + BH (P_THRESH là mức FDR)
+SIGNIFICANCE = 'pearson'
+N_PERMUTATIONS = 1000
+PERMUTATION_SEED = 42
+
+# Cache (r, p, n, validated) theo hash dữ liệu biểu hiện + ứng viên + tập bệnh nhân:
+# đổi P_THRESH / R_THRESH / BONUS chỉ còn là lọc + gộp trên cache
+USE_CORRELATION_CACHE = True
+
+# True: thêm cột ensembl_id ngay khi ghi cạnh (không cần chạy lại ensemble_transfer.py)
+EDGE_ENSEMBL_COLUMN = False
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-def clean_cols(df):
-    df.columns = ['-'.join(x.split('-')[:3]) for x in df.columns]
-    return df.groupby(df.columns, axis=1).mean()
+def select_edges(candidates, r, p):
+    """Lọc cặp theo P_THRESH / R_THRESH, weight = |r| (+BONUS nếu validated, tối đa 1.0)."""
+    keep = (p < P_THRESH) & (r < R_THRESH)
+    weight = np.abs(r[keep])
+    validated = candidates['validated'].to_numpy(dtype=bool)[keep]
+    weight = np.where(validated, np.minimum(1.0, weight + BONUS), weight)
 
-def build_edges():
-    logging.info("Loading data...")
-    try:
-        # Load và Clean Data
-        gene_df = pd.read_csv(GENE_PATH, sep='\t', index_col=0)
-        if 'Entrez_Gene_Id' in gene_df.columns: gene_df.drop(columns=['Entrez_Gene_Id'], inplace=True)
-        gene_df = clean_cols(gene_df[~gene_df.index.duplicated()])
-        
-        mir_df = pd.read_csv(MIR_PATH, sep='\t', index_col=0)
-        mir_df = clean_cols(mir_df)
-        
-        # Intersection Patients
-        common = gene_df.columns.intersection(mir_df.columns)
-        if len(common) == 0: return logging.error("No common patients.")
-        gene_df, mir_df = gene_df[common], mir_df[common]
-        
-        # Load Candidates
+    # --- QUAN TRỌNG: LƯU ID PRECURSOR ---
+    return pd.DataFrame({
+        'mirna_id': candidates['pre_id'].to_numpy()[keep], # Lưu ID cha để khớp với Node Features
+        'gene_id': candidates['gene_id'].to_numpy()[keep],
+        'weight': weight
+    })
+
+def load_candidates():
+    """Bảng ứng viên (mirna_id, gene_id, validated) từ miRTarBase + TargetScan, bỏ cặp trùng."""
+    with ins.phase('load_candidates'):
         val = pd.read_csv(MIRTAR_PATH); val['validated'] = True
         pred = pd.read_csv(TARGET_PATH); pred['validated'] = False
         candidates = pd.concat([val, pred]).drop_duplicates(subset=['mirna_id', 'gene_id'])
-        
-        # --- BƯỚC 1: TẠO MAP (Regex) ---
-        # Map: Core Name (mir-122) -> Precursor ID (hsa-mir-122)
-        expr_map = {}
-        for idx in mir_df.index:
-            # Regex bắt: (mir hoặc let) - (chuỗi số/chữ)
-            m = re.search(r'(mir|let)-([0-9a-z]+)', idx, re.IGNORECASE)
-            if m:
-                # Key chuẩn hóa về dạng: mir-122 (chữ thường)
-                core = m.group(0).lower().replace('mir', 'mir')
-                expr_map[core] = idx # Lưu ID gốc trong file
-                
-        logging.info(f"Expression Map created for {len(expr_map)} precursors.")
-
-        # --- BƯỚC 2: TÍNH TOÁN ---
-        results = []
-        gene_cache = gene_df.to_dict('index')
-        mir_cache = mir_df.to_dict('index')
-        valid_genes = set(gene_df.index)
-
-        for _, row in tqdm(candidates.iterrows(), total=len(candidates), desc="Processing"):
-            mature_id = row['mirna_id'] # VD: hsa-miR-122-5p
-            gene = row['gene_id']
-            
-            if gene not in valid_genes: continue
-
-            # Tìm ID Precursor tương ứng (Cha)
-            target_pre_id = None
-            m = re.search(r'(mir|let)-([0-9a-z]+)', mature_id, re.IGNORECASE)
-            if m:
-                core = m.group(0).lower().replace('mir', 'mir')
-                target_pre_id = expr_map.get(core)
-            
-            if not target_pre_id: continue # Không có data biểu hiện -> Bỏ qua
-
-            # Lấy vector & Tính Correlation
-            try:
-                vec_m = pd.Series(mir_cache[target_pre_id])
-                vec_g = pd.Series(gene_cache[gene])
-                
-                if vec_m.var() == 0 or vec_g.var() == 0: continue
-                
-                r, p = pearsonr(vec_m, vec_g)
-                
-                if p < P_THRESH and r < R_THRESH:
-                    w = abs(r)
-                    if row['validated']: w = min(1.0, w + BONUS)
-                    
-                    # --- QUAN TRỌNG: LƯU ID PRECURSOR ---
-                    results.append({
-                        'mirna_id': target_pre_id, # Lưu ID cha để khớp với Node Features
-                        'gene_id': gene,
-                        'weight': w
-                    })
-            except: continue
-
-        # --- BƯỚC 3: GỘP TRÙNG LẶP ---
-        # Nếu cả 5p và 3p cùng trỏ vào 1 gene -> Giữ cái có trọng số cao nhất
-        final_df = pd.DataFrame(results)
-        if not final_df.empty:
-            final_df = final_df.sort_values('weight', ascending=False)
-            final_df = final_df.drop_duplicates(subset=['mirna_id', 'gene_id'], keep='first')
-            
-            os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
-            final_df.to_csv(OUTPUT_PATH, index=False)
-            logging.info(f"SUCCESS: {len(final_df)} edges saved to {OUTPUT_PATH}")
+    ins.rows_in('candidates', len(val) + len(pred))
+    ins.drop('candidates', 'duplicate_pair', len(val) + len(pred) - len(candidates))
+    return candidates
+
+def correlate_all(candidates, gene_header, mir_header, common, gene_path=GENE_PATH, mir_path=MIR_PATH,
+                  n_workers=N_WORKERS, shard_size=SHARD_SIZE):
+    """
+    Tính (r, p) cho mọi ứng viên dùng được.
+    Trả về bảng pre_id, gene_id, r, p, n, validated (r = NaN nếu dòng có variance 0).
+    """
+    # --- BƯỚC 1: TRA ID PRECURSOR ---
+    # Mature (hsa-miR-122-5p) -> Core (mir-122) -> dòng Precursor trong ma trận miRNA, tính sẵn + cache theo hash file
+    with ins.phase('resolve_ids'):
+        id_index = load_id_index(mir_path, [MIRTAR_PATH, TARGET_PATH], expression_ids=mir_header[0])
+        pre_idx = id_index.precursor_rows(candidates['mirna_id'])
+
+    # Gene trùng symbol -> giữ dòng đầu tiên
+    first_gene = ~gene_header[0].duplicated()
+    ins.drop('genes', 'duplicate_symbol', (~first_gene).sum())
+    gene_pos = gene_header[0][first_gene].get_indexer(candidates['gene_id'])
+    gene_pos = np.where(gene_pos >= 0, np.flatnonzero(first_gene)[np.maximum(gene_pos, 0)], -1)
+    usable = (gene_pos >= 0) & (pre_idx >= 0) # Không có gene / không có data biểu hiện -> Bỏ qua
+    ins.drop('candidates', 'gene_missing', (gene_pos < 0).sum())
+    ins.drop('candidates', 'precursor_missing', ((gene_pos >= 0) & (pre_idx < 0)).sum())
+    candidates = candidates[usable]
+
+    # --- BƯỚC 2: ĐỌC ĐÚNG CÁC DÒNG / CỘT CẦN ---
+    # Chỉ gene + precursor có trong bảng ứng viên, chỉ bệnh nhân chung (barcode trùng -> trung bình lúc đọc)
+    gene_rows, gene_idx = np.unique(gene_pos[usable], return_inverse=True)
+    mir_rows, pre_idx = np.unique(pre_idx[usable], return_inverse=True)
+    with ins.phase('load_expression'):
+        gene_mat = read_patient_matrix(gene_path, gene_rows, common, header=gene_header)
+        mir_mat = read_patient_matrix(mir_path, mir_rows, common, header=mir_header)
+    with ins.phase('transform'): # Spearman: xếp hạng 1 lần cho cả ma trận, không phải theo từng cặp
+        gene_mat = transform_rows(gene_mat, ASSOCIATION)
+        mir_mat = transform_rows(mir_mat, ASSOCIATION)
+    ins.count('genes_loaded', len(gene_rows)); ins.count('precursors_loaded', len(mir_rows))
+
+    # --- BƯỚC 3: TÍNH TOÁN (Vector hóa) ---
+    logging.info(f"Correlating {len(candidates)} candidate pairs over {len(common)} patients ({ASSOCIATION})...")
+    with ins.phase('correlate'):
+        r, p = correlate_candidates_parallel(gene_mat, mir_mat, gene_idx, pre_idx,
+                                             n_workers=n_workers, shard_size=shard_size)
+    with ins.phase('significance'):
+        if SIGNIFICANCE == 'pearson_fdr': # BH trên cặp (precursor, gene) riêng biệt, như permutation_fdr
+            p = pair_qvalues(p, gene_idx, pre_idx)
+        elif SIGNIFICANCE == 'permutation_fdr':
+            logging.info(f"Permutation test: {N_PERMUTATIONS} permutations (seed={PERMUTATION_SEED}) + Benjamini-Hochberg...")
+            p = permutation_qvalues(gene_mat, mir_mat, gene_idx, pre_idx, r, N_PERMUTATIONS, seed=PERMUTATION_SEED)
+
+    return pd.DataFrame({
+        'pre_id': mir_header[0].to_numpy()[mir_rows][pre_idx],
+        'gene_id': candidates['gene_id'].to_numpy(),
+        'r': r, 'p': p,
+        'n': np.full(len(r), len(common), dtype=np.int32),
+        'validated': candidates['validated'].to_numpy(dtype=bool),
+    })
+
+def edges_for_patients(gene_path, mir_path, output_path, patients=None, candidates=None,
+                       n_workers=N_WORKERS, shard_size=SHARD_SIZE, use_cache=USE_CORRELATION_CACHE, prune_cache=True):
+    """
+    build_edges cho một cặp ma trận biểu hiện, tùy chọn chỉ trên một tập bệnh nhân (cohort).
+    candidates: bảng ứng viên đã nạp sẵn (chế độ batch) -> không đọc lại file tương tác.
+    prune_cache=False: không dọn cache tương quan (chế độ batch dọn một lần ở process chính).
+    Trả về dict tóm tắt, hoặc None nếu dữ liệu không dùng được.
+    """
+    if SIGNIFICANCE not in ('pearson', 'pearson_fdr', 'permutation_fdr'):
+        return logging.error(f"Unknown SIGNIFICANCE mode: {SIGNIFICANCE}")
+    if ASSOCIATION not in ASSOCIATIONS:
+        return logging.error(f"Unknown ASSOCIATION mode: {ASSOCIATION}")
+
+    # Chỉ đọc header: ID dòng + barcode -> giao bệnh nhân trước khi đọc giá trị
+    with ins.phase('read_headers'):
+        gene_header = read_expression_header(gene_path) # Store nhị phân nếu có, không thì TSV
+        mir_header = read_expression_header(mir_path)
+    gene_patients = gene_header[1].map(patient_barcode).unique()
+    mir_patients = mir_header[1].map(patient_barcode).unique()
+    
+    # Intersection Patients
+    common = pd.Index(gene_patients).intersection(pd.Index(mir_patients)).sort_values()
+    if patients is not None:
+        common = common.intersection(pd.Index([patient_barcode(p) for p in patients]).unique()).sort_values()
+    ins.count('patients_gene', len(gene_patients)); ins.count('patients_mirna', len(mir_patients)); ins.count('patients_common', len(common))
+    if len(common) == 0: return logging.error("No common patients.")
+
+    table = None
+    if use_cache:
+        key = cache_key([gene_path, mir_path], [MIRTAR_PATH, TARGET_PATH], common,
+                        {'association': ASSOCIATION, 'significance': SIGNIFICANCE, 'n_permutations': N_PERMUTATIONS, 'seed': PERMUTATION_SEED})
+        table = load_results(key)
+    cached = table is not None
+    if cached:
+        logging.info(f"Using cached correlations for {len(table)} candidate pairs.")
+        ins.count('correlation_cache_hits')
+        ins.rows_in('candidates', len(table))
+    else:
+        if candidates is None:
+            candidates = load_candidates()
         else:
-            logging.warning("No edges passed filter.")
+            ins.rows_in('candidates', len(candidates))
+        table = correlate_all(candidates, gene_header, mir_header, common, gene_path, mir_path, n_workers, shard_size)
+        if use_cache:
+            save_results(key, table, prune=prune_cache)
+
+    # --- BƯỚC 4: LỌC + GỘP TRÙNG LẶP THEO KHỐI ---
+    # Nếu cả 5p và 3p cùng trỏ vào 1 gene -> Giữ cái có trọng số cao nhất (gộp theo key, không sort toàn bộ)
+    writer = EdgeWriter()
+    with ins.phase('select_edges'):
+        for start in range(0, len(table), EDGE_CHUNK_ROWS):
+            chunk = table.iloc[start:start + EDGE_CHUNK_ROWS]
+            r, p = chunk['r'].to_numpy(), chunk['p'].to_numpy()
+            edges = select_edges(chunk, r, p)
+            writer.add(edges['mirna_id'], edges['gene_id'], edges['weight'])
+            ins.drop('candidates', 'zero_variance', np.isnan(r).sum())
+            ins.drop('candidates', 'below_threshold', (~np.isnan(r)).sum() - len(edges))
+    ins.rows_out('candidates', writer.n_added)
+
+    # Không có cạnh nào vẫn ghi file (chỉ header) + .meta.json -> không để sót file cạnh của lần chạy trước
+    ins.rows_in('edges', writer.n_added)
+    ensembl_map = None
+    if EDGE_ENSEMBL_COLUMN:
+        ensembl_map = convert_symbols_to_ensembl_with_fallback(writer.gene_ids()) if len(writer) else {}
+    with ins.phase('write_edges'):
+        n_edges = writer.write(output_path, ensembl_map=ensembl_map, metadata={
+            'association': ASSOCIATION, 'significance': SIGNIFICANCE, 'p_thresh': P_THRESH,
+            'r_thresh': R_THRESH, 'bonus': BONUS, 'patients': len(common)})
+    ins.drop('edges', 'duplicate_precursor_gene', writer.n_added - n_edges)
+    ins.rows_out('edges', n_edges)
+    if n_edges:
+        logging.info(f"SUCCESS: {n_edges} edges saved to {output_path}")
+    else:
+        logging.warning(f"No edges passed filter; wrote an empty edge file to {output_path}")
+    return {'association': ASSOCIATION, 'patients': len(common), 'candidate_pairs': len(table), 'edges': n_edges, 'cached': cached}
 
+def build_edges(n_workers=N_WORKERS, shard_size=SHARD_SIZE, use_cache=USE_CORRELATION_CACHE):
+    logging.info("Loading data...")
+    try:
+        edges_for_patients(GENE_PATH, MIR_PATH, OUTPUT_PATH, n_workers=n_workers, shard_size=shard_size, use_cache=use_cache)
     except Exception as e:
+        ins.error('build_edges', e)
         logging.error(f"Pipeline failed: {e}")
 
 if __name__ == "__main__":
-    build_edges()
\ No newline at end of file
+    with ins.stage('build_edges'):
+        build_edges()
\ No newline at end of file
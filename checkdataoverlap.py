@@ -1,5 +1,10 @@
 import pandas as pd
+import numpy as np
 import os
+import sys
+
+from expression_store import read_expression_header, patient_barcode
+from mirna_ids import load_id_index, mirna_cores
 
 # --- CẤU HÌNH ĐƯỜNG DẪN (Chỉnh lại cho đúng máy bạn) ---
 GENE_EXPR = 'data/features/genes_expr.txt'  # File biểu hiện Gene
@@ -7,57 +12,109 @@ MIRNA_EXPR = 'data/features/mirnas.tsv'     # File biểu hiện miRNA
 MIRTARBASE = 'data/processed/mirtarbase_processed.csv'
 TARGETSCAN = 'data/processed/targetscan_processed.csv'
 
+# Ngưỡng cho chế độ pre-flight (exit code 1 nếu không đạt)
+MIN_COMMON_PATIENTS = 3
+MIN_USABLE_PAIRS = 1
+
+def _pct(part, total):
+    return f"{part} / {total} ({part / total * 100:.1f}%)" if total else f"{part} / 0"
+
 def check_overlap():
+    """
+    Chỉ đọc index (ID dòng + barcode) của 2 ma trận, tra ID theo đúng chuỗi của build_edges:
+    ID gốc -> core (mir-122) -> precursor có biểu hiện; gene symbol -> dòng gene.
+    Trả về dict số liệu (dùng làm pre-flight gate).
+    """
     print("--- DIAGNOSTIC REPORT ---")
-    
-    # 1. Kiểm tra miRNA Expression
+    summary = {'common_patients': 0, 'usable_pairs': 0}
+
+    # 1. Index của 2 ma trận biểu hiện (store: rows.txt / columns.txt, TSV: cột đầu + header)
     try:
-        mir_df = pd.read_csv(MIRNA_EXPR, sep='\t', index_col=0)
-        print(f"[Expression] miRNAs loaded: {len(mir_df)}")
-        print(f"   > Sample IDs (first 3): {list(mir_df.index[:3])}")
+        mir_ids, mir_columns = read_expression_header(MIRNA_EXPR)
+        print(f"[Expression] miRNAs: {len(mir_ids)}, samples: {len(mir_columns)}")
+        print(f"   > Sample IDs (first 3): {list(mir_ids[:3])}")
     except Exception as e:
         print(f"[Error] Cannot read miRNA file: {e}")
-        return
+        return summary
 
-    # 2. Kiểm tra Gene Expression
     try:
-        gene_df = pd.read_csv(GENE_EXPR, sep='\t', index_col=0) # Index col có thể là 'Hugo_Symbol'
-        print(f"[Expression] Genes loaded: {len(gene_df)}")
-        print(f"   > Sample IDs (first 3): {list(gene_df.index[:3])}")
+        gene_ids, gene_columns = read_expression_header(GENE_EXPR) # Index col có thể là 'Hugo_Symbol'
+        print(f"[Expression] Genes: {len(gene_ids)} ({gene_ids.duplicated().sum()} duplicated symbols), samples: {len(gene_columns)}")
+        print(f"   > Sample IDs (first 3): {list(gene_ids[:3])}")
     except Exception as e:
         print(f"[Error] Cannot read Gene file: {e}")
-        return
+        return summary
+
+    # 2. Bệnh nhân chung sau khi cắt barcode (như build_edges)
+    gene_patients = pd.Index(gene_columns.map(patient_barcode).unique())
+    mir_patients = pd.Index(mir_columns.map(patient_barcode).unique())
+    common = gene_patients.intersection(mir_patients)
+    summary['common_patients'] = len(common)
+    print(f"[Patients] gene: {len(gene_patients)}, miRNA: {len(mir_patients)}, common: {len(common)}")
+
+    # Bảng tra mature -> precursor giống hệt build_edges (dùng chung cache)
+    try:
+        id_index = load_id_index(MIRNA_EXPR, [MIRTARBASE, TARGETSCAN], expression_ids=mir_ids)
+    except Exception as e:
+        print(f"[Warning] Cannot build miRNA ID index: {e}")
+        id_index = None
+    expr_cores = set(mirna_cores(mir_ids).dropna())
 
-    # 3. Kiểm tra Interaction Data
+    # 3. Kiểm tra Interaction Data theo từng bước của chuỗi tra ID
     for name, path in [('miRTarBase', MIRTARBASE), ('TargetScan', TARGETSCAN)]:
         print(f"\nChecking {name}...")
         try:
-            inter_df = pd.read_csv(path)
-            unique_mirs = set(inter_df['mirna_id'])
-            unique_genes = set(inter_df['gene_id'])
-            
+            inter_df = pd.read_csv(path, usecols=['mirna_id', 'gene_id'], dtype=str)
+            unique_mirs = pd.Index(inter_df['mirna_id'].dropna().unique())
+            unique_genes = pd.Index(inter_df['gene_id'].dropna().unique())
+
             print(f"   > Total interactions: {len(inter_df)}")
             print(f"   > Unique miRNAs in interactions: {len(unique_mirs)}")
             print(f"   > Unique Genes in interactions: {len(unique_genes)}")
-            
-            # --- KIỂM TRA GIAO NHAU (INTERSECTION) ---
-            # Xem bao nhiêu miRNA trong file tương tác CÓ MẶT trong file biểu hiện
-            valid_mirs = unique_mirs.intersection(mir_df.index)
-            print(f"   > [CRITICAL] miRNAs found in Expression data: {len(valid_mirs)} / {len(unique_mirs)} ({len(valid_mirs)/len(unique_mirs)*100:.1f}%)")
-            
-            if len(valid_mirs) == 0:
-                print("     !!! CẢNH BÁO: Không khớp miRNA ID nào. Kiểm tra lại định dạng (ví dụ: 'hsa-miR-122-5p' vs 'MIMAT...')")
-                print(f"     Example Interaction ID: {list(unique_mirs)[0]}")
-                print(f"     Example Expression ID:  {list(mir_df.index)[0]}")
-
-            # Xem bao nhiêu Gene trong file tương tác CÓ MẶT trong file biểu hiện
-            valid_genes = unique_genes.intersection(gene_df.index)
-            print(f"   > [CRITICAL] Genes found in Expression data: {len(valid_genes)} / {len(unique_genes)} ({len(valid_genes)/len(unique_genes)*100:.1f}%)")
-            
-            if len(valid_genes) == 0:
+
+            # --- miRNA: từng bước của chuỗi tra ID ---
+            # Khớp ID gốc gần như luôn ~0% (mature vs precursor) -> chỉ để tham khảo
+            cores = mirna_cores(unique_mirs)
+            print(f"   > miRNA exact ID match:        {_pct(int(unique_mirs.isin(mir_ids).sum()), len(unique_mirs))}")
+            print(f"   > miRNA core parsed:           {_pct(int(cores.notna().sum()), len(unique_mirs))}")
+            print(f"   > miRNA core in expression:    {_pct(int(cores.isin(expr_cores).sum()), len(unique_mirs))}")
+            pre_rows = None
+            if id_index is not None:
+                pre_rows = id_index.precursor_rows(inter_df['mirna_id'])
+                resolved = int((id_index.precursor_rows(unique_mirs) >= 0).sum())
+                print(f"   > [CRITICAL] miRNAs resolved to an expression precursor: {_pct(resolved, len(unique_mirs))}")
+                print(f"     Distinct precursors used: {len(np.unique(pre_rows[pre_rows >= 0]))} / {len(mir_ids)}")
+                if resolved == 0:
+                    print("     !!! CẢNH BÁO: Không khớp miRNA ID nào. Kiểm tra lại định dạng (ví dụ: 'hsa-miR-122-5p' vs 'MIMAT...')")
+                    print(f"     Example Interaction ID: {unique_mirs[0] if len(unique_mirs) else None}")
+                    print(f"     Example Expression ID:  {mir_ids[0] if len(mir_ids) else None}")
+
+            # --- Gene ---
+            gene_found = inter_df['gene_id'].isin(gene_ids).to_numpy()
+            valid_genes = int(unique_genes.isin(gene_ids).sum())
+            print(f"   > [CRITICAL] Genes found in Expression data: {_pct(valid_genes, len(unique_genes))}")
+            if valid_genes == 0:
                 print("     !!! CẢNH BÁO: Không khớp Gene ID nào. Kiểm tra lại định dạng (ví dụ: Symbol vs ENSG)")
+
+            # --- Cặp dùng được (ứng viên build_edges sẽ tính, trước khi gộp trùng giữa 2 file) ---
+            if pre_rows is not None:
+                usable = int(((pre_rows >= 0) & gene_found).sum())
+                summary['usable_pairs'] += usable
+                print(f"   > Pairs with gene:             {_pct(int(gene_found.sum()), len(inter_df))}")
+                print(f"   > Pairs with precursor:        {_pct(int((pre_rows >= 0).sum()), len(inter_df))}")
+                print(f"   > [CRITICAL] Usable pairs:     {_pct(usable, len(inter_df))}")
         except Exception as e:
             print(f"   > Cannot read file {path}: {e}")
 
+    return summary
+
+def preflight_ok(summary):
+    return summary['common_patients'] >= MIN_COMMON_PATIENTS and summary['usable_pairs'] >= MIN_USABLE_PAIRS
+
 if __name__ == "__main__":
-    check_overlap()
\ No newline at end of file
+    # python checkdataoverlap.py [--gate] -> --gate: exit code 1 nếu dữ liệu chưa đủ để chạy build_edges
+    summary = check_overlap()
+    if '--gate' in sys.argv[1:]:
+        ok = preflight_ok(summary)
+        print(f"\n[Pre-flight] {'OK' if ok else 'FAILED'}: {summary}")
+        sys.exit(0 if ok else 1)
\ No newline at end of file
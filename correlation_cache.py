@@ -0,0 +1,81 @@
+# scripts/correlation_cache.py
+import numpy as np
+import pandas as pd
+import os
+import glob
+import logging
+from contextlib import suppress
+
+from expression_store import has_fresh_store, store_path_for
+from fingerprint import file_digest, combine_digests
+
+# --- CẤU HÌNH ---
+CORRELATION_CACHE_DIR = 'data/cache/correlations'
+CACHE_VERSION = 3 # Tăng khi đổi cách tính r / p -> cache cũ tự mất hiệu lực
+CACHE_KEEP = 4    # Số file cache mới nhất giữ lại (các key cũ bị xóa)
+
+# Cột lưu trong cache. ID (chuỗi) được mã hóa từ điển: giá trị duy nhất + mã int32.
+ID_COLUMNS = ['pre_id', 'gene_id']
+VALUE_COLUMNS = {'r': np.float64, 'p': np.float64, 'n': np.int32, 'validated': np.bool_}
+
+def expression_digest(path):
+    """Hash nội dung ma trận biểu hiện: store nhị phân nếu có (đang được dùng), không thì TSV."""
+    return file_digest(store_path_for(path) if has_fresh_store(path) else path)
+
+def cache_key(expression_paths, interaction_paths, patients, params):
+    """Key = nội dung biểu hiện + tập ứng viên + tập bệnh nhân + tham số tính p (không gồm ngưỡng lọc)."""
+    return combine_digests(CACHE_VERSION, *(expression_digest(p) for p in expression_paths),
+                           *(file_digest(p) for p in interaction_paths),
+                           combine_digests(*sorted(patients)), sorted(params.items()))
+
+def cache_path_for(key, cache_dir=CORRELATION_CACHE_DIR):
+    return os.path.join(cache_dir, f"{key}.npz")
+
+def prune_cache(keep=CACHE_KEEP, cache_dir=CORRELATION_CACHE_DIR):
+    """Giữ `keep` file mới nhất. File có thể bị process khác xóa giữa chừng -> bỏ qua."""
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*.npz')):
+        with suppress(FileNotFoundError):
+            entries.append((os.path.getmtime(path), path))
+    for _, old in sorted(entries)[:-keep or None]:
+        with suppress(FileNotFoundError):
+            os.remove(old)
+
+def save_results(key, table, cache_dir=CORRELATION_CACHE_DIR, prune=True):
+    """
+    Ghi bảng (pre_id, gene_id, r, p, n, validated) dạng cột, ghi tạm rồi rename.
+    prune=False: không dọn cache (chế độ batch: process chính dọn một lần sau khi xong).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = {}
+    for column in ID_COLUMNS:
+        codes, uniques = pd.factorize(table[column])
+        arrays[f'{column}_codes'] = codes.astype(np.int32)
+        arrays[f'{column}_values'] = np.asarray(uniques, dtype=str)
+    for column, dtype in VALUE_COLUMNS.items():
+        arrays[column] = table[column].to_numpy(dtype=dtype)
+
+    path = cache_path_for(key, cache_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp" # Tên tạm riêng cho từng process
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+    if prune:
+        prune_cache(CACHE_KEEP, cache_dir)
+    logging.info(f"Cached {len(table)} correlation results ({path}).")
+
+def load_results(key, cache_dir=CORRELATION_CACHE_DIR):
+    """Bảng kết quả đã lưu cho key, hoặc None nếu chưa có / hỏng."""
+    path = cache_path_for(key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as cache:
+            table = {column: cache[f'{column}_values'][cache[f'{column}_codes']] for column in ID_COLUMNS}
+            table.update({column: cache[column] for column in VALUE_COLUMNS})
+        os.utime(path) # Đánh dấu vừa dùng -> không bị xóa khi dọn cache
+        return pd.DataFrame(table)
+    except Exception as e:
+        logging.warning(f"Correlation cache unusable ({e}); recomputing.")
+        return None
\ No newline at end of file
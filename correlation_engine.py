@@ -0,0 +1,255 @@
+# scripts/correlation_engine.py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy import special, stats
+from tqdm import tqdm
+
+# --- CẤU HÌNH ---
+MAX_BLOCK_ROWS = 4096  # Số cặp tối đa nhân ma trận trong một lần (giới hạn RAM)
+SHARD_SIZE = 64        # Số precursor trong mỗi shard khi chạy song song
+PERMUTATION_MEMORY_BYTES = 256 * 1024 * 1024 # Trần bộ nhớ cho một lô hoán vị
+NULL_TOLERANCE = 1e-12 # |r_null| >= |r_obs| - tol: tránh sai số làm mất chính hoán vị đồng nhất
+ASSOCIATIONS = ('pearson', 'spearman', 'log_pearson') # Thước đo liên hệ hỗ trợ
+LOG_PSEUDOCOUNT = 1.0 # log_pearson: log2(x + pseudocount)
+
+# Ma trận z-score của worker (gắn vào shared memory trong initializer)
+_WORKER_ARRAYS = {}
+
+
+def transform_rows(matrix, association='pearson'):
+    """
+    Biến đổi ma trận một lần trước khi z-score, sau đó dùng lại nguyên đường tính Pearson theo lô:
+    'spearman' -> hạng trong từng dòng (trùng -> hạng trung bình, như scipy.stats.spearmanr),
+    'log_pearson' -> log2(x + LOG_PSEUDOCOUNT). Dòng có NaN -> NaN (bị loại như dòng hằng số).
+    """
+    if association == 'pearson':
+        return matrix
+    if association == 'spearman':
+        return stats.rankdata(matrix, axis=1)
+    if association == 'log_pearson':
+        with np.errstate(invalid='ignore'):
+            return np.log2(np.asarray(matrix, dtype=np.float64) + LOG_PSEUDOCOUNT)
+    raise ValueError(f"Unknown association mode: {association}")
+
+
+def zscore_rows(matrix):
+    """
+    Chuẩn hóa từng dòng: trừ mean, chia norm -> r(x, y) = dot(z_x, z_y).
+    Dòng hằng số (variance = 0) được đặt NaN để loại khỏi kết quả.
+    """
+    mat = np.ascontiguousarray(matrix, dtype=np.float64) # Dòng liên tục trong bộ nhớ
+    centered = mat - mat.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.einsum('ij,ij->i', centered, centered))
+    constant = (mat == mat[:, :1]).all(axis=1) | (norms == 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = centered / norms[:, None]
+    z[constant] = np.nan
+    return z
+
+
+def pearson_pvalues(r, n):
+    """p-value hai phía của Pearson r (n mẫu), tính bằng phân phối t với n-2 bậc tự do."""
+    r = np.asarray(r, dtype=np.float64)
+    dof = n - 2
+    if dof < 1:
+        return np.full(r.shape, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = r * np.sqrt(dof / ((1.0 - r) * (1.0 + r)))
+    return 2.0 * special.stdtr(dof, -np.abs(t))
+
+
+def correlate_pairs(gene_z, mir_z, gene_idx, pre_idx, desc="Correlating"):
+    """
+    Tính r cho từng cặp (gene_idx[i], pre_idx[i]) trên 2 ma trận đã z-score.
+    Các cặp được gom theo precursor -> mỗi nhóm là một phép nhân ma trận-vector.
+    Kết quả trả về theo đúng thứ tự đầu vào.
+    """
+    gene_idx = np.asarray(gene_idx, dtype=np.int64)
+    pre_idx = np.asarray(pre_idx, dtype=np.int64)
+    r = np.full(len(gene_idx), np.nan)
+    if len(gene_idx) == 0:
+        return r
+
+    order = np.argsort(pre_idx, kind='stable')
+    bounds = np.flatnonzero(np.diff(pre_idx[order])) + 1
+    groups = np.split(order, bounds)
+
+    for group in tqdm(groups, desc=desc, disable=desc is None):
+        mir_vec = mir_z[pre_idx[group[0]]]
+        if len(group) > gene_z.shape[0] // 4:
+            # Nhóm lớn: nhân toàn bộ ma trận gene một lần rồi lấy các dòng cần
+            r[group] = (gene_z @ mir_vec)[gene_idx[group]]
+            continue
+        for start in range(0, len(group), MAX_BLOCK_ROWS):
+            block = group[start:start + MAX_BLOCK_ROWS]
+            r[block] = gene_z[gene_idx[block]] @ mir_vec
+
+    return np.clip(r, -1.0, 1.0)
+
+
+def correlate_candidates(gene_mat, mir_mat, gene_idx, pre_idx):
+    """Pearson (r, p) cho tất cả cặp ứng viên. Cột của 2 ma trận phải cùng thứ tự bệnh nhân."""
+    gene_z = zscore_rows(gene_mat)
+    mir_z = zscore_rows(mir_mat)
+    r = correlate_pairs(gene_z, mir_z, gene_idx, pre_idx)
+    p = pearson_pvalues(r, gene_z.shape[1])
+    return r, p
+
+
+def benjamini_hochberg(p):
+    """q-value Benjamini-Hochberg trên toàn bộ tập kiểm định (NaN giữ nguyên, không tính vào m)."""
+    p = np.asarray(p, dtype=np.float64)
+    q = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p))
+    if len(valid) == 0:
+        return q
+    order = valid[np.argsort(p[valid], kind='stable')]
+    ranked = p[order] * len(order) / np.arange(1, len(order) + 1)
+    q[order] = np.minimum(1.0, np.minimum.accumulate(ranked[::-1])[::-1])
+    return q
+
+
+def unique_pairs(gene_idx, pre_idx):
+    """Cặp (precursor, gene) lặp lại (5p/3p cùng precursor): (vị trí lần đầu của mỗi cặp, ánh xạ mọi dòng -> cặp)."""
+    gene_idx = np.asarray(gene_idx, dtype=np.int64)
+    pre_idx = np.asarray(pre_idx, dtype=np.int64)
+    keys = pre_idx * (int(gene_idx.max(initial=0)) + 1) + gene_idx
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return first, inverse
+
+
+def pair_qvalues(p, gene_idx, pre_idx):
+    """Benjamini-Hochberg trên các cặp (precursor, gene) riêng biệt -> cặp lặp lại chỉ tính một lần trong m."""
+    first, inverse = unique_pairs(gene_idx, pre_idx)
+    return benjamini_hochberg(np.asarray(p)[first])[inverse]
+
+
+def permutation_pvalues(gene_z, mir_z, gene_idx, pre_idx, r_obs, n_permutations, seed=0, memory_budget=PERMUTATION_MEMORY_BYTES):
+    """
+    p-value hoán vị (hai phía) cho mọi cặp cùng lúc: hoán vị nhãn bệnh nhân của vector precursor,
+    mỗi lô B hoán vị là một phép nhân ma trận (cặp x bệnh nhân) @ (bệnh nhân x B).
+    Null được gộp qua mọi cặp (r của 2 dòng z-score cùng n bệnh nhân có cùng phân phối null):
+    p = (#|r_null| >= |r_obs| trong N * m giá trị null + 1) / (N * m + 1). p riêng từng cặp có sàn
+    1 / (N + 1), quá lớn để BH trên hàng triệu cặp bác bỏ được gì.
+    Null không được lưu: mỗi giá trị null cộng 1 cho mọi cặp có |r_obs| <= |r_null| (đếm trên |r_obs| đã sắp xếp).
+    Mọi cặp dùng chung một dãy hoán vị sinh từ seed -> kết quả không phụ thuộc memory_budget.
+    """
+    gene_idx = np.asarray(gene_idx, dtype=np.int64)
+    pre_idx = np.asarray(pre_idx, dtype=np.int64)
+    abs_obs = np.abs(np.asarray(r_obs, dtype=np.float64)) - NULL_TOLERANCE
+    valid = ~np.isnan(abs_obs)
+    sorted_obs = np.sort(abs_obs[valid])
+    below = np.zeros(len(sorted_obs) + 1, dtype=np.int64) # below[k]: số null có đúng k giá trị |r_obs| <= nó
+    n = mir_z.shape[1]
+
+    # Bộ nhớ mỗi hoán vị: chỉ số hoán vị + vector null + một cột kết quả cho mỗi khối cặp
+    per_permutation = n * 8 * 2 + MAX_BLOCK_ROWS * 8 * 2
+    batch = int(min(max(1, memory_budget // per_permutation), n_permutations))
+
+    order = np.argsort(pre_idx, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(pre_idx[order])) + 1) if len(order) else []
+
+    rng = np.random.default_rng(seed)
+    with tqdm(total=n_permutations, desc="Permutations") as progress:
+        for start in range(0, n_permutations, batch):
+            size = min(batch, n_permutations - start)
+            perms = np.stack([rng.permutation(n) for _ in range(size)])
+            for group in groups:
+                null_vecs = mir_z[pre_idx[group[0]]][perms] # B x n
+                for block_start in range(0, len(group), MAX_BLOCK_ROWS):
+                    block = group[block_start:block_start + MAX_BLOCK_ROWS]
+                    block = block[valid[block]] # Dòng hằng số -> không phải một kiểm định, không góp null
+                    r_null = np.abs(gene_z[gene_idx[block]] @ null_vecs.T) # cặp x B
+                    below += np.bincount(np.searchsorted(sorted_obs, r_null.ravel(), side='right'), minlength=len(below))
+            progress.update(size)
+
+    # Null >= |r_obs| của cặp thứ j (theo thứ tự sắp xếp) <=> null có hơn j giá trị |r_obs| <= nó
+    exceed = np.cumsum(below[::-1])[::-1][1:]
+    p = np.full(len(abs_obs), np.nan)
+    p[np.flatnonzero(valid)[np.argsort(abs_obs[valid], kind='stable')]] = (exceed + 1.0) / (n_permutations * len(sorted_obs) + 1.0)
+    return p
+
+
+def permutation_qvalues(gene_mat, mir_mat, gene_idx, pre_idx, r, n_permutations, seed=0, memory_budget=PERMUTATION_MEMORY_BYTES):
+    """
+    Permutation p + Benjamini-Hochberg trên toàn bộ ứng viên.
+    Cặp (precursor, gene) lặp lại (5p/3p cùng precursor) chỉ được kiểm định một lần.
+    """
+    gene_idx = np.asarray(gene_idx, dtype=np.int64)
+    pre_idx = np.asarray(pre_idx, dtype=np.int64)
+    first, inverse = unique_pairs(gene_idx, pre_idx)
+
+    p = permutation_pvalues(zscore_rows(gene_mat), zscore_rows(mir_mat), gene_idx[first], pre_idx[first],
+                            np.asarray(r)[first], n_permutations, seed, memory_budget)
+    return benjamini_hochberg(p)[inverse]
+
+
+# --- CHẠY SONG SONG (Process Pool + Shared Memory) ---
+
+def _to_shared(array):
+    """Copy mảng vào một block shared memory, trả về (block, spec) để worker gắn lại."""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_shared(specs):
+    """Initializer của worker: mở các block shared memory, không copy dữ liệu."""
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _WORKER_ARRAYS[key] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+
+
+def _correlate_shard(positions, gene_idx, pre_idx):
+    gene_z = _WORKER_ARRAYS['gene'][1]
+    mir_z = _WORKER_ARRAYS['mir'][1]
+    return positions, correlate_pairs(gene_z, mir_z, gene_idx, pre_idx, desc=None)
+
+
+def make_shards(pre_idx, shard_size=SHARD_SIZE):
+    """Chia vị trí các cặp thành shard theo precursor (mỗi shard tối đa shard_size precursor)."""
+    pre_idx = np.asarray(pre_idx, dtype=np.int64)
+    order = np.argsort(pre_idx, kind='stable')
+    _, starts = np.unique(pre_idx[order], return_index=True)
+    cuts = starts[shard_size::shard_size]
+    return [shard for shard in np.split(order, cuts) if len(shard)]
+
+
+def correlate_candidates_parallel(gene_mat, mir_mat, gene_idx, pre_idx, n_workers, shard_size=SHARD_SIZE):
+    """
+    Như correlate_candidates nhưng chia shard theo precursor cho n_workers process.
+    Ma trận z-score nằm trong shared memory (không pickle cho từng worker);
+    mỗi precursor được tính trọn trong một shard nên kết quả giống hệt chạy đơn.
+    """
+    if not n_workers or n_workers <= 1:
+        return correlate_candidates(gene_mat, mir_mat, gene_idx, pre_idx)
+
+    gene_idx = np.asarray(gene_idx, dtype=np.int64)
+    pre_idx = np.asarray(pre_idx, dtype=np.int64)
+    gene_z = zscore_rows(gene_mat)
+    mir_z = zscore_rows(mir_mat)
+    r = np.full(len(gene_idx), np.nan)
+
+    blocks = []
+    try:
+        specs = {}
+        for key, array in (('gene', gene_z), ('mir', mir_z)):
+            shm, specs[key] = _to_shared(array)
+            blocks.append(shm)
+        del gene_z, mir_z
+
+        shards = make_shards(pre_idx, shard_size)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach_shared, initargs=(specs,)) as pool:
+            futures = [pool.submit(_correlate_shard, s, gene_idx[s], pre_idx[s]) for s in shards]
+            for future in tqdm(futures, desc="Correlating shards"):
+                positions, shard_r = future.result()
+                r[positions] = shard_r
+        n = specs['gene'][1][1]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return r, pearson_pvalues(r, n)
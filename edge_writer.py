@@ -0,0 +1,100 @@
+# scripts/edge_writer.py
+import numpy as np
+import pandas as pd
+import os
+import json
+
+# --- CẤU HÌNH ---
+EDGE_CHUNK_ROWS = 1000000 # Số cạnh gom trong buffer trước khi gộp / số dòng mỗi lần ghi CSV
+
+def _encode(codes, ids):
+    """ID chuỗi -> mã int64 ổn định qua các khối (codes: dict dùng chung, được bổ sung dần)."""
+    local, uniques = pd.factorize(np.asarray(ids))
+    mapping = np.fromiter((codes.setdefault(u, len(codes)) for u in uniques), dtype=np.int64, count=len(uniques))
+    return mapping[local]
+
+def metadata_path_for(path):
+    return path + '.meta.json'
+
+def write_metadata(path, metadata):
+    """Ghi file mô tả kèm file cạnh (ghi tạm rồi rename như file cạnh)."""
+    with open(metadata_path_for(path) + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(metadata_path_for(path) + '.tmp', metadata_path_for(path))
+
+def read_metadata(path):
+    """Mô tả của file cạnh, hoặc None nếu file được ghi bởi phiên bản cũ."""
+    if not os.path.exists(metadata_path_for(path)):
+        return None
+    with open(metadata_path_for(path)) as f:
+        return json.load(f)
+
+class EdgeWriter:
+    """
+    Ghi cạnh (mirna_id, gene_id, weight) theo khối thay cho list + sort toàn bộ.
+    ID được mã hóa thành số, buffer là mảng có kiểu; mỗi cặp (mirna, gene) chỉ giữ weight lớn nhất
+    bằng gộp theo key (groupby max), thứ tự cặp = thứ tự xuất hiện đầu tiên.
+    """
+    def __init__(self, chunk_rows=EDGE_CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self.mirna_codes, self.gene_codes = {}, {}
+        self.best = pd.Series(dtype=np.float64) # key (mirna << 32 | gene) -> weight lớn nhất
+        self.n_added = 0
+        self._keys, self._weights, self._buffered = [], [], 0
+
+    def add(self, mirna_ids, gene_ids, weights):
+        if len(weights) == 0:
+            return
+        keys = (_encode(self.mirna_codes, mirna_ids) << 32) | _encode(self.gene_codes, gene_ids)
+        self._keys.append(keys)
+        self._weights.append(np.asarray(weights, dtype=np.float64))
+        self._buffered += len(keys)
+        self.n_added += len(keys)
+        if self._buffered >= self.chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._keys:
+            return
+        keys = np.concatenate([self.best.index.to_numpy(dtype=np.int64)] + self._keys)
+        weights = np.concatenate([self.best.to_numpy()] + self._weights)
+        self.best = pd.Series(weights, index=keys).groupby(level=0, sort=False).max()
+        self._keys, self._weights, self._buffered = [], [], 0
+
+    def __len__(self):
+        self._flush()
+        return len(self.best)
+
+    def gene_ids(self):
+        """Các gene symbol đã gặp (để tra Ensembl một lần trước khi ghi)."""
+        return list(self.gene_codes)
+
+    def write(self, path, ensembl_map=None, metadata=None):
+        """
+        Ghi CSV theo khối. ensembl_map (symbol -> Ensembl) -> thêm cột ensembl_id (rỗng nếu không tra được).
+        metadata (thước đo liên hệ, ngưỡng, ...) -> ghi kèm vào <path>.meta.json.
+        """
+        self._flush()
+        mirna_names = np.array(list(self.mirna_codes), dtype=object)
+        gene_names = np.array(list(self.gene_codes), dtype=object)
+        gene_ensembl = None
+        if ensembl_map is not None:
+            gene_ensembl = np.array([ensembl_map.get(g) for g in gene_names], dtype=object)
+
+        keys, weights = self.best.index.to_numpy(dtype=np.int64), self.best.to_numpy()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w', newline='') as out:
+            columns = ['mirna_id', 'gene_id', 'weight'] + (['ensembl_id'] if gene_ensembl is not None else [])
+            out.write(','.join(columns) + '\n')
+            for start in range(0, len(keys), self.chunk_rows):
+                block = keys[start:start + self.chunk_rows]
+                gene = block & 0xFFFFFFFF
+                chunk = {'mirna_id': mirna_names[block >> 32], 'gene_id': gene_names[gene],
+                         'weight': weights[start:start + self.chunk_rows]}
+                if gene_ensembl is not None:
+                    chunk['ensembl_id'] = gene_ensembl[gene]
+                pd.DataFrame(chunk).to_csv(out, index=False, header=False)
+        os.replace(path + '.tmp', path)
+        if metadata is not None:
+            write_metadata(path, dict(metadata, edges=int(len(keys))))
+        return len(keys)
\ No newline at end of file
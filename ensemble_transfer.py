@@ -1,13 +1,17 @@
 # scripts/ensemble_transfer.py
 import pandas as pd
-import mygene
 import os
 import logging
-from tqdm import tqdm
+
+from gene_resolver import GeneSymbolResolver, RemoteLookupError, RESOLVER_DB_PATH
+from remote_lookup import AsyncBatchBackend, MyGeneClient
+from edge_writer import read_metadata, write_metadata
+import instrumentation as ins
 
 # --- CẤU HÌNH ---
 INPUT_EDGES_PATH = 'data/edges/gene_mirna.csv'
 OUTPUT_EDGES_PATH = 'data/edges/gene_mirna_ensembl.csv'
+CONVERT_CHUNK_ROWS = 1000000 # Số cạnh đọc / map / ghi mỗi lần
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- BẢN ĐỒ SỬA LỖI THỦ CÔNG (FINAL VERSION) ---
@@ -55,81 +59,71 @@ MANUAL_CORRECTION_MAP = {
 
 # --- HÀM THỰC THI ---
 
-def convert_symbols_to_ensembl_with_fallback(gene_symbols):
-    """Chuyển đổi ID với phạm vi tìm kiếm mở rộng và Map thủ công."""
-    logging.info(f"Querying MyGene.info for {len(gene_symbols)} unique gene symbols...")
-    mg = mygene.MyGeneInfo()
-    
-    # Tìm kiếm mở rộng cả alias và tên cũ
-    results = mg.querymany(
-        gene_symbols, 
-        scopes='symbol,alias,prev_symbol,reporter', 
-        fields='ensembl.gene', 
-        species='human', 
-        verbose=False
-    )
-    
-    mapping = {}
-    not_found_initially = []
-    
-    for res in tqdm(results, desc="Building map"):
-        query = res.get('query')
-        ensembl_info = res.get('ensembl')
-        
-        if ensembl_info:
-            if isinstance(ensembl_info, list):
-                ensembl_id = ensembl_info[0].get('gene')
-            else:
-                ensembl_id = ensembl_info.get('gene')
-            
-            if ensembl_id:
-                mapping[query] = ensembl_id
-        
-        if query not in mapping:
-            not_found_initially.append(query)
-            
-    # Giai đoạn 2: Sửa lỗi thủ công
-    final_not_found = []
-    if not_found_initially:
-        not_found_initially = list(set(not_found_initially))
-        logging.info(f"Checking manual map for {len(not_found_initially)} missing genes...")
-        
-        for symbol in not_found_initially:
-            if symbol in MANUAL_CORRECTION_MAP:
-                mapping[symbol] = MANUAL_CORRECTION_MAP[symbol]
-            else:
-                final_not_found.append(symbol)
-        
-        if final_not_found:
-            logging.warning(f"STILL MISSING {len(final_not_found)} GENES: {final_not_found}")
-        else:
-            logging.info("All missing genes resolved manually!")
+def convert_symbols_to_ensembl_with_fallback(gene_symbols, resolver=None):
+    """
+    Chuyển đổi ID: index offline (HGNC/Ensembl + cache) -> Map thủ công -> MyGene.info cho các symbol còn thiếu
+    (theo lô, song song có giới hạn, thử lại + checkpoint: xem remote_lookup.py).
+    """
+    own_resolver = resolver is None
+    if own_resolver:
+        resolver = GeneSymbolResolver(RESOLVER_DB_PATH, remote=AsyncBatchBackend(MyGeneClient()), manual_map=MANUAL_CORRECTION_MAP)
+
+    logging.info(f"Resolving {len(gene_symbols)} unique gene symbols...")
+    try:
+        with ins.phase('resolve_symbols'):
+            mapping = resolver.resolve_many(gene_symbols)
+    finally:
+        if own_resolver: resolver.close()
+
+    final_not_found = [s for s in dict.fromkeys(gene_symbols) if s not in mapping]
+    ins.count('symbols_resolved', len(mapping)); ins.count('symbols_missing', len(final_not_found))
+    if final_not_found:
+        logging.warning(f"STILL MISSING {len(final_not_found)} GENES: {final_not_found}")
+    else:
+        logging.info("All genes resolved!")
 
     return mapping
 
-def convert_edge_file_to_ensembl(input_path, output_path):
+def convert_edge_file_to_ensembl(input_path, output_path, resolver=None, chunk_rows=CONVERT_CHUNK_ROWS):
+    # Lượt 1: chỉ đọc cột gene_id theo khối -> tập symbol duy nhất -> bảng tra cố định
     try:
-        df = pd.read_csv(input_path)
-    except FileNotFoundError:
+        unique_symbols = {}
+        for chunk in pd.read_csv(input_path, usecols=['gene_id'], dtype=str, chunksize=chunk_rows):
+            unique_symbols.update(dict.fromkeys(chunk['gene_id'].dropna().unique()))
+    except FileNotFoundError as e:
+        ins.error('read_edges', e)
         logging.error(f"FATAL: Input file not found at {input_path}.")
         return
 
-    unique_symbols = df['gene_id'].unique().tolist()
-    symbol_to_ensembl_map = convert_symbols_to_ensembl_with_fallback(unique_symbols)
+    try:
+        symbol_to_ensembl_map = convert_symbols_to_ensembl_with_fallback(list(unique_symbols), resolver=resolver)
+    except RemoteLookupError as e: # Không ghi output thiếu -> pipeline không coi stage là xong
+        ins.error('resolve_symbols', e)
+        logging.error(f"FATAL: Remote lookup incomplete ({e}). {output_path} was not written.")
+        return
     
+    # Lượt 2: map + ghi từng khối (ghi file tạm rồi rename)
     logging.info("Applying mapping...")
-    df['gene_id'] = df['gene_id'].map(symbol_to_ensembl_map)
-    
-    original_rows = len(df)
-    df.dropna(subset=['gene_id'], inplace=True)
-    new_rows = len(df)
+    original_rows = new_rows = 0
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with ins.phase('map_edges'), open(output_path + '.tmp', 'w', newline='') as out:
+        for i, df in enumerate(pd.read_csv(input_path, dtype={'gene_id': str}, chunksize=chunk_rows)):
+            df['gene_id'] = df['gene_id'].map(symbol_to_ensembl_map)
+            original_rows += len(df)
+            df = df.dropna(subset=['gene_id'])
+            new_rows += len(df)
+            df.to_csv(out, index=False, header=(i == 0))
+    os.replace(output_path + '.tmp', output_path)
+    metadata = read_metadata(input_path) # Giữ thước đo liên hệ / ngưỡng của file cạnh gốc
+    if metadata is not None:
+        write_metadata(output_path, dict(metadata, edges=new_rows, gene_ids='ensembl'))
+    ins.rows_in('edges', original_rows); ins.rows_out('edges', new_rows)
+    ins.drop('edges', 'unmapped_symbol', original_rows - new_rows)
     
     logging.info(f"--- DONE ---")
     logging.info(f"Saved to: {output_path}")
-    logging.info(f"Rows retained: {new_rows}/{original_rows} ({new_rows/original_rows*100:.1f}%)")
-    
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    df.to_csv(output_path, index=False)
+    logging.info(f"Rows retained: {new_rows}/{original_rows} ({new_rows/max(original_rows, 1)*100:.1f}%)")
 
 if __name__ == "__main__":
-    convert_edge_file_to_ensembl(INPUT_EDGES_PATH, OUTPUT_EDGES_PATH)
\ No newline at end of file
+    with ins.stage('ensembl_transfer'):
+        convert_edge_file_to_ensembl(INPUT_EDGES_PATH, OUTPUT_EDGES_PATH)
\ No newline at end of file
@@ -0,0 +1,204 @@
+# scripts/expression_store.py
+import numpy as np
+import pandas as pd
+import os
+import sys
+import json
+import shutil
+import logging
+
+# --- CẤU HÌNH ---
+GENE_EXPR_PATH = 'data/features/genes_expr.txt'
+MIRNA_EXPR_PATH = 'data/features/mirnas.tsv'
+
+STORE_SUFFIX = '.store'            # mirnas.tsv -> mirnas.store/
+MATRIX_FILE = 'matrix.npy'         # float32, row-major, mở bằng memory-map
+ROWS_FILE = 'rows.txt'             # ID của dòng (gene / miRNA), mỗi dòng một ID
+COLUMNS_FILE = 'columns.txt'       # ID bệnh nhân (barcode), mỗi dòng một ID
+META_FILE = 'meta.json'
+META_COLUMNS = ['Entrez_Gene_Id']  # Cột thông tin, không phải bệnh nhân
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def store_path_for(path):
+    """data/features/mirnas.tsv -> data/features/mirnas.store (giữ nguyên nếu đã là store)."""
+    if path.rstrip('/').endswith(STORE_SUFFIX):
+        return path.rstrip('/')
+    return os.path.splitext(path)[0] + STORE_SUFFIX
+
+def _write_lines(path, values):
+    with open(path, 'w') as f:
+        for value in values:
+            f.write(f"{value}\n")
+
+def _read_lines(path):
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
+class StoreWriter:
+    """
+    Ghi store theo khối dòng (không cần cả ma trận trong RAM) vào một thư mục tạm;
+    close() ghi index + meta rồi đổi tên cả thư mục vào chỗ store cũ -> reader không bao giờ thấy store ghi dở
+    (trong khoảnh khắc đổi tên, store vắng mặt và reader dùng TSV).
+    """
+    def __init__(self, store_path, rows, columns, index_name=None):
+        self.store_path = store_path.rstrip('/')
+        self.rows, self.columns, self.index_name = list(rows), list(columns), index_name
+        self.tmp_path = f"{self.store_path}.{os.getpid()}.tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.matrix = np.lib.format.open_memmap(os.path.join(self.tmp_path, MATRIX_FILE), mode='w+', dtype=np.float32,
+                                                shape=(len(self.rows), len(self.columns)))
+
+    def write(self, start, block):
+        self.matrix[start:start + len(block)] = block
+
+    def close(self):
+        self.matrix.flush()
+        del self.matrix
+        _write_lines(os.path.join(self.tmp_path, ROWS_FILE), self.rows)
+        _write_lines(os.path.join(self.tmp_path, COLUMNS_FILE), self.columns)
+        meta = {'shape': [len(self.rows), len(self.columns)], 'dtype': 'float32', 'index_name': self.index_name}
+        with open(os.path.join(self.tmp_path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        old_path = f"{self.store_path}.{os.getpid()}.old"
+        if os.path.exists(self.store_path):
+            os.replace(self.store_path, old_path)
+        os.replace(self.tmp_path, self.store_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        logging.info(f"Saved binary expression store to {self.store_path}. Shape: {tuple(meta['shape'])}")
+
+    def discard(self):
+        """Bỏ store đang ghi dở (store cũ giữ nguyên)."""
+        if hasattr(self, 'matrix'):
+            del self.matrix
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+def write_store(df, store_path):
+    """Ghi DataFrame (dòng x bệnh nhân) thành store nhị phân: matrix float32 + index dòng/cột."""
+    df = df.drop(columns=[c for c in META_COLUMNS if c in df.columns])
+    writer = StoreWriter(store_path, df.index, df.columns, index_name=df.index.name)
+    writer.write(0, df.to_numpy(dtype=np.float32))
+    writer.close()
+
+def open_store(store_path):
+    """Mở store (zero-copy): trả về (matrix memmap chỉ đọc, row_ids, patient_ids)."""
+    matrix = np.load(os.path.join(store_path, MATRIX_FILE), mmap_mode='r')
+    with open(os.path.join(store_path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    rows = pd.Index(_read_lines(os.path.join(store_path, ROWS_FILE)), name=meta.get('index_name'))
+    columns = pd.Index(_read_lines(os.path.join(store_path, COLUMNS_FILE)))
+    if matrix.shape != (len(rows), len(columns)):
+        raise ValueError(f"Corrupted store {store_path}: matrix {matrix.shape} vs index ({len(rows)}, {len(columns)})")
+    return matrix, rows, columns
+
+def has_fresh_store(path):
+    """Store tồn tại và không cũ hơn file TSV gốc (nếu có)."""
+    store_path = store_path_for(path)
+    meta_path = os.path.join(store_path, META_FILE)
+    if not os.path.exists(meta_path):
+        return False
+    if path != store_path and os.path.exists(path):
+        return os.path.getmtime(meta_path) >= os.path.getmtime(path)
+    return True
+
+def iter_expression_chunks(path, chunk_rows):
+    """Đọc ma trận theo khối chunk_rows dòng (DataFrame, bỏ cột META_COLUMNS): store -> lát memmap, TSV -> chunksize."""
+    if has_fresh_store(path):
+        matrix, rows, columns = open_store(store_path_for(path))
+        for start in range(0, len(rows), chunk_rows):
+            yield pd.DataFrame(matrix[start:start + chunk_rows], index=rows[start:start + chunk_rows], columns=columns)
+        return
+    for chunk in pd.read_csv(path, sep='\t', index_col=0, chunksize=chunk_rows):
+        yield chunk.drop(columns=[c for c in META_COLUMNS if c in chunk.columns])
+
+def read_expression_ids(path):
+    """Chỉ đọc ID dòng (cột đầu tiên) - không parse ma trận."""
+    if has_fresh_store(path):
+        return open_store(store_path_for(path))[1]
+    ids = pd.read_csv(path, sep='\t', usecols=[0], dtype=str).iloc[:, 0]
+    return pd.Index(ids, name=ids.name)
+
+def patient_barcode(column):
+    """TCGA-XX-XXXX-01A-... -> TCGA-XX-XXXX (mã bệnh nhân = 3 phần đầu của barcode)."""
+    return '-'.join(column.split('-')[:3])
+
+def read_expression_header(path):
+    """(ID dòng, cột bệnh nhân) mà không đọc giá trị. Cột META_COLUMNS bị bỏ."""
+    if has_fresh_store(path):
+        _, rows, columns = open_store(store_path_for(path))
+        return rows, columns
+    with open(path, 'r') as f:
+        columns = pd.Index(f.readline().rstrip('\r\n').split('\t')[1:])
+    return read_expression_ids(path), columns[~columns.isin(META_COLUMNS)]
+
+def read_expression_rows(path, row_positions, column_positions):
+    """
+    Chỉ đọc các dòng / cột cần (vị trí tăng dần, theo read_expression_header) -> float64.
+    Store: fancy-index trên memmap. TSV: bỏ qua dòng không cần trước khi parse số.
+    """
+    row_positions = np.asarray(row_positions, dtype=np.int64)
+    column_positions = np.asarray(column_positions, dtype=np.int64)
+    if has_fresh_store(path):
+        matrix = open_store(store_path_for(path))[0]
+        return np.asarray(matrix[np.ix_(row_positions, column_positions)], dtype=np.float64)
+
+    with open(path, 'r') as f:
+        header = f.readline().rstrip('\r\n').split('\t')
+    patient_columns = [i for i, c in enumerate(header) if i > 0 and c not in META_COLUMNS]
+    wanted = set((row_positions + 1).tolist()) # Dòng 0 = header
+    df = pd.read_csv(path, sep='\t', index_col=0, usecols=[0] + [patient_columns[c] for c in column_positions],
+                     skiprows=lambda i: i > 0 and i not in wanted)
+    return df.to_numpy(dtype=np.float64)
+
+def read_patient_matrix(path, row_positions, patients, header=None):
+    """
+    Ma trận (row_positions x patients): chỉ đọc các cột có barcode thuộc patients,
+    barcode trùng bệnh nhân được lấy trung bình ngay khi đọc (bỏ NaN, như groupby().mean()).
+    """
+    rows, columns = header if header is not None else read_expression_header(path)
+    patients = pd.Index(patients)
+    owner = patients.get_indexer(columns.map(patient_barcode))
+    column_positions = np.flatnonzero(owner >= 0)
+    if len(np.unique(owner[column_positions])) != len(patients):
+        raise ValueError(f"{path}: some requested patients have no column")
+    if len(patients) == 0:
+        return np.empty((len(row_positions), 0))
+
+    values = read_expression_rows(path, row_positions, column_positions)
+    order = np.argsort(owner[column_positions], kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(owner[column_positions][order]) != 0])
+    values = values[:, order]
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0.0), starts, axis=1)
+    counts = np.add.reduceat(present, starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def export_tsv(store_path, tsv_path):
+    """Xuất store ra TSV (định dạng cũ) cho các công cụ bên ngoài."""
+    matrix, rows, columns = open_store(store_path)
+    df = pd.DataFrame(matrix, index=rows, columns=columns, copy=False)
+    os.makedirs(os.path.dirname(tsv_path) or '.', exist_ok=True)
+    df.to_csv(tsv_path, sep='\t')
+    logging.info(f"Exported {store_path} to {tsv_path}")
+
+def convert_tsv_to_store(tsv_path):
+    logging.info(f"Converting {tsv_path} to binary store...")
+    df = pd.read_csv(tsv_path, sep='\t', index_col=0)
+    write_store(df, store_path_for(tsv_path))
+
+if __name__ == "__main__":
+    # python expression_store.py [file.tsv ...] -> tạo store cạnh mỗi file
+    # python expression_store.py --export <store (hoặc file.tsv có store)> <output.tsv> -> xuất lại TSV
+    if sys.argv[1:2] == ['--export']:
+        if len(sys.argv) != 4:
+            sys.exit("Usage: python expression_store.py --export <store> <output.tsv>")
+        export_tsv(store_path_for(sys.argv[2]), sys.argv[3])
+        sys.exit(0)
+    for tsv in sys.argv[1:] or [GENE_EXPR_PATH, MIRNA_EXPR_PATH]:
+        if os.path.exists(tsv):
+            convert_tsv_to_store(tsv)
+        else:
+            logging.error(f"File not found: {tsv}")
@@ -0,0 +1,33 @@
+# scripts/fingerprint.py
+import hashlib
+import os
+
+# --- CẤU HÌNH ---
+READ_BLOCK_BYTES = 8 * 1024 * 1024
+
+# (đường dẫn tuyệt đối, size, mtime) -> digest: không hash lại cùng một file trong một lần chạy
+_DIGEST_MEMO = {}
+
+def file_digest(path):
+    """SHA-1 nội dung file (hex). Thư mục -> hash các file bên trong theo thứ tự tên."""
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        return combine_digests(*(f"{name}:{file_digest(os.path.join(path, name))}" for name in names))
+
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _DIGEST_MEMO:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_BLOCK_BYTES), b''):
+                sha.update(block)
+        _DIGEST_MEMO[memo_key] = sha.hexdigest()
+    return _DIGEST_MEMO[memo_key]
+
+def combine_digests(*parts):
+    """Gộp nhiều digest / tham số (chuỗi, số) thành một key duy nhất."""
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(repr(part).encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
@@ -0,0 +1,222 @@
+# scripts/gene_resolver.py
+import pandas as pd
+import os
+import sys
+import sqlite3
+import logging
+from collections import OrderedDict
+
+# --- CẤU HÌNH ---
+RESOLVER_DB_PATH = 'data/reference/gene_symbols.sqlite'
+HGNC_DUMP_PATH = 'data/raw/hgnc_complete_set.txt' # HGNC "complete set" (TSV)
+LRU_SIZE = 100000  # Số symbol giữ trong bộ nhớ
+SQL_BATCH = 500    # Số symbol mỗi câu SELECT ... IN (...)
+
+# Cột trong file dump -> loại symbol. Thứ tự = độ ưu tiên (symbol chính thức thắng alias).
+HGNC_COLUMNS = {
+    'ensembl': 'ensembl_gene_id',
+    'symbol': 'symbol',
+    'prev_symbol': 'prev_symbol',
+    'alias': 'alias_symbol',
+}
+MULTI_VALUE_SEP = '|' # HGNC ghi nhiều alias trong 1 ô: "A|B|C"
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- REMOTE BACKENDS ---
+# Backend chỉ cần hàm lookup(symbols) -> {symbol: ensembl_id hoặc None}.
+# Một phần không hỏi được (lỗi mạng) -> raise RemoteLookupError kèm phần đã trả lời (lần sau hỏi lại phần thiếu).
+
+class RemoteLookupError(RuntimeError):
+    def __init__(self, message, found):
+        super().__init__(message)
+        self.found = found # {symbol: ensembl_id hoặc None} của các lô đã thành công
+
+def ensembl_from_hits(results):
+    """Kết quả query của MyGene (list hit, có thể nhiều hit / query) -> {query: Ensembl ID đầu tiên hoặc None}."""
+    mapping = {}
+    for res in results:
+        query = res.get('query')
+        ensembl_info = res.get('ensembl')
+        if isinstance(ensembl_info, list):
+            ensembl_info = ensembl_info[0]
+        ensembl_id = ensembl_info.get('gene') if ensembl_info else None
+        if ensembl_id or query not in mapping:
+            mapping[query] = ensembl_id
+    return mapping
+
+class StaticBackend:
+    """Backend cục bộ từ một dict (dùng cho test / chạy offline hoàn toàn)."""
+    def __init__(self, mapping=None):
+        self.mapping = dict(mapping or {})
+        self.queries = [] # Ghi lại các symbol đã bị hỏi -> kiểm tra chỉ miss mới đi "remote"
+
+    def lookup(self, symbols):
+        self.queries.extend(symbols)
+        return {s: self.mapping.get(s) for s in symbols}
+
+# --- INDEX TRÊN ĐĨA (SQLite) ---
+
+def connect(db_path=RESOLVER_DB_PATH):
+    if os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    con = sqlite3.connect(db_path)
+    con.execute("""CREATE TABLE IF NOT EXISTS symbols (
+                       symbol TEXT PRIMARY KEY,
+                       ensembl_id TEXT,      -- NULL = đã hỏi remote nhưng không có kết quả
+                       source TEXT NOT NULL)""")
+    return con
+
+def load_hgnc_dump(dump_path=HGNC_DUMP_PATH, db_path=RESOLVER_DB_PATH, columns=HGNC_COLUMNS, replace=True):
+    """
+    Nạp file dump HGNC/Ensembl vào index. Symbol chính thức được ghi trước,
+    sau đó tên cũ và alias (không ghi đè mục ưu tiên hơn). Mục của dump luôn thay kết quả remote đã cache
+    (kể cả "không tìm thấy") -> nạp dump mới sửa được symbol remote từng trả lời sai / thiếu.
+    """
+    logging.info(f"Loading gene symbol dump: {dump_path}")
+    usecols = [c for c in columns.values()]
+    df = pd.read_csv(dump_path, sep='\t', dtype=str, usecols=lambda c: c in usecols)
+    df = df.dropna(subset=[columns['ensembl']])
+
+    con = connect(db_path)
+    with con:
+        if replace:
+            con.execute("DELETE FROM symbols WHERE source IN (%s)" % ','.join('?' * (len(columns) - 1)),
+                        [kind for kind in columns if kind != 'ensembl'])
+        for kind, column in columns.items():
+            if kind == 'ensembl' or column not in df.columns:
+                continue
+            pairs = df[[column, columns['ensembl']]].dropna()
+            pairs = pairs.assign(**{column: pairs[column].str.split(MULTI_VALUE_SEP, regex=False)}).explode(column)
+            pairs[column] = pairs[column].str.strip()
+            pairs = pairs[pairs[column] != '']
+            con.executemany("INSERT INTO symbols (symbol, ensembl_id, source) VALUES (?, ?, ?) "
+                            "ON CONFLICT(symbol) DO UPDATE SET ensembl_id = excluded.ensembl_id, source = excluded.source "
+                            "WHERE symbols.source = 'remote'",
+                            ((s, e, kind) for s, e in pairs.itertuples(index=False)))
+    count = con.execute("SELECT COUNT(*) FROM symbols").fetchone()[0]
+    con.close()
+    logging.info(f"Resolver index now holds {count} symbols ({db_path}).")
+
+class GeneSymbolResolver:
+    """
+    Symbol -> Ensembl: LRU trong bộ nhớ -> index SQLite -> (bản đồ thủ công) -> remote backend.
+    Kết quả remote (kể cả không tìm thấy) được ghi lại vào index để lần sau chạy offline.
+    """
+    def __init__(self, db_path=RESOLVER_DB_PATH, remote=None, manual_map=None, lru_size=LRU_SIZE):
+        self.con = connect(db_path)
+        self.remote = remote
+        self.manual_map = manual_map or {}
+        self.lru_size = lru_size
+        self._lru = OrderedDict()
+
+    def close(self):
+        self.con.close()
+
+    def _remember(self, symbol, ensembl_id):
+        self._lru[symbol] = ensembl_id
+        self._lru.move_to_end(symbol)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _query_index(self, symbols):
+        found = {}
+        for start in range(0, len(symbols), SQL_BATCH):
+            batch = symbols[start:start + SQL_BATCH]
+            rows = self.con.execute("SELECT symbol, ensembl_id FROM symbols WHERE symbol IN (%s)" % ','.join('?' * len(batch)), batch)
+            found.update(rows)
+        return found
+
+    def resolve_many(self, symbols):
+        """Trả về {symbol: ensembl_id} cho các symbol giải được."""
+        symbols = list(dict.fromkeys(s for s in symbols if isinstance(s, str)))
+        mapping, misses = {}, []
+        for s in symbols:
+            if s in self._lru:
+                self._lru.move_to_end(s)
+                mapping[s] = self._lru[s]
+            else:
+                misses.append(s)
+
+        found = self._query_index(misses)
+        for s, ensembl_id in found.items():
+            if ensembl_id:
+                mapping[s] = ensembl_id
+                self._remember(s, ensembl_id)
+        misses = [s for s in misses if s not in mapping]
+
+        # Bản đồ sửa lỗi thủ công: tri thức cục bộ, không cần hỏi remote
+        for s in [s for s in misses if s in self.manual_map]:
+            mapping[s] = self.manual_map[s]
+            self._remember(s, mapping[s])
+        # Symbol đã hỏi remote trước đó mà không có kết quả (NULL) -> không hỏi lại
+        misses = [s for s in misses if s not in self.manual_map and s not in found]
+
+        if misses and self.remote is not None:
+            error = None
+            try:
+                remote_found = self.remote.lookup(misses)
+            except RemoteLookupError as e: # Vẫn lưu phần đã trả lời rồi mới báo lỗi
+                remote_found, error = e.found, e
+            answered = [s for s in misses if s in remote_found] # Chỉ lưu symbol remote đã trả lời (kể cả "không có")
+            with self.con:
+                self.con.executemany("INSERT OR REPLACE INTO symbols (symbol, ensembl_id, source) VALUES (?, ?, 'remote')",
+                                     ((s, remote_found[s]) for s in answered))
+            for s in answered:
+                mapping[s] = remote_found[s]
+                self._remember(s, mapping[s])
+            if error is not None:
+                raise error
+
+        return {s: e for s, e in mapping.items() if e}
+
+    def resolve(self, symbol):
+        return self.resolve_many([symbol]).get(symbol)
+
+def expect_equal(what, actual, expected):
+    """Kiểm tra của self-check: raise thay cho assert (assert bị bỏ qua khi chạy python -O)."""
+    if actual != expected:
+        raise RuntimeError(f"Self-check failed: {what}: got {actual!r}, expected {expected!r}")
+
+def self_check():
+    """
+    Kiểm tra chuỗi tra cứu với backend cục bộ (không cần mạng, DB tạm):
+    LRU -> SQLite -> bản đồ thủ công -> remote chỉ cho symbol còn thiếu; dump mới thay kết quả remote cũ.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        dump_path, db_path = os.path.join(tmp, 'hgnc.txt'), os.path.join(tmp, 'symbols.sqlite')
+        pd.DataFrame({'symbol': ['TP53', 'EGFR'], 'alias_symbol': ['P53', 'ERBB|TP53'], 'prev_symbol': [None, None],
+                      'ensembl_gene_id': ['ENSG00000141510', 'ENSG00000146648']}).to_csv(dump_path, sep='\t', index=False)
+        load_hgnc_dump(dump_path, db_path)
+
+        remote = StaticBackend({'REMOTE1': 'ENSG00000000001'})
+        resolver = GeneSymbolResolver(db_path, remote=remote, manual_map={'MANUAL1': 'ENSG00000000002'}, lru_size=2)
+        found = resolver.resolve_many(['TP53', 'P53', 'ERBB', 'MANUAL1', 'REMOTE1', 'FOO'])
+        expect_equal("resolved symbols", found, {'TP53': 'ENSG00000141510', 'P53': 'ENSG00000141510', 'ERBB': 'ENSG00000146648',
+                                                 'MANUAL1': 'ENSG00000000002', 'REMOTE1': 'ENSG00000000001'})
+        expect_equal("remote queries", remote.queries, ['REMOTE1', 'FOO']) # Chỉ symbol thiếu mới hỏi remote
+        expect_equal("LRU size", len(resolver._lru), 2) # LRU bị giới hạn
+
+        # Lần 2: remote không được hỏi lại (kể cả FOO "không tìm thấy" đã cache)
+        expect_equal("second lookup", resolver.resolve_many(['REMOTE1', 'FOO', 'TP53']),
+                     {'REMOTE1': 'ENSG00000000001', 'TP53': 'ENSG00000141510'})
+        expect_equal("remote queries after second lookup", remote.queries, ['REMOTE1', 'FOO'])
+        resolver.close()
+
+        # Dump mới có FOO -> thay mục remote "không tìm thấy"
+        pd.DataFrame({'symbol': ['TP53', 'FOO'], 'alias_symbol': [None, None], 'prev_symbol': [None, None],
+                      'ensembl_gene_id': ['ENSG00000141510', 'ENSG00000000003']}).to_csv(dump_path, sep='\t', index=False)
+        load_hgnc_dump(dump_path, db_path)
+        resolver = GeneSymbolResolver(db_path, remote=StaticBackend())
+        expect_equal("FOO after reloading the dump", resolver.resolve('FOO'), 'ENSG00000000003')
+        resolver.close()
+    logging.info("Resolver self-check passed.")
+
+if __name__ == "__main__":
+    # python gene_resolver.py [hgnc_complete_set.txt] -> dựng index offline
+    # python gene_resolver.py --self-check -> kiểm tra chuỗi tra cứu với backend cục bộ
+    if sys.argv[1:] == ['--self-check']:
+        self_check()
+    else:
+        load_hgnc_dump(sys.argv[1] if len(sys.argv) > 1 else HGNC_DUMP_PATH)
@@ -0,0 +1,151 @@
+# scripts/instrumentation.py
+import cProfile
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+# --- CẤU HÌNH ---
+REPORT_DIR = 'data/reports' # <stage>.json (+ <stage>.prof khi bật profile)
+PROFILE = False # True: dump cProfile cho mỗi stage (xem bằng `python -m pstats` / snakeviz)
+
+def rss_mb(field='VmHWM'):
+    """Peak (VmHWM) hoặc hiện tại (VmRSS) của process, MB. ru_maxrss giữ giá trị qua exec nên chỉ là fallback."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _reset_peak():
+    """Đặt lại VmHWM = VmRSS (Linux >= 4.0). False nếu không hỗ trợ -> peak là peak của cả process."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class RunRecorder:
+    """
+    Số liệu của một lần chạy: timer theo phase (thời gian, peak RSS), counter,
+    và sổ dòng vào / ra / bị loại (kèm lý do) cho từng bước.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.phases = {}
+        self.counters = {}
+        self.rows = {}
+        self.errors = []
+        self._stack = [] # Phase lồng nhau: peak của phase cha >= peak của phase con
+
+    @contextmanager
+    def phase(self, name):
+        name = '/'.join([frame['name'] for frame in self._stack] + [name])
+        if self._stack: # Giữ lại peak của phase cha trước khi đặt lại VmHWM
+            self._stack[-1]['child_peak'] = max(self._stack[-1]['child_peak'], rss_mb())
+        frame = {'name': name.rsplit('/', 1)[-1], 'child_peak': 0.0, 'exact': _reset_peak()}
+        self._stack.append(frame)
+        rss_before = rss_mb('VmRSS')
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._stack.pop()
+            peak = max(rss_mb(), frame['child_peak'])
+            if self._stack:
+                self._stack[-1]['child_peak'] = max(self._stack[-1]['child_peak'], peak)
+            stats = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0, 'rss_delta_mb': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] = round(stats['seconds'] + seconds, 4)
+            stats['peak_rss_mb'] = round(max(stats['peak_rss_mb'], peak), 1)
+            stats['rss_delta_mb'] = round(stats['rss_delta_mb'] + rss_mb('VmRSS') - rss_before, 1)
+            stats['peak_is_exact'] = frame['exact']
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def _step(self, step):
+        return self.rows.setdefault(step, {'in': 0, 'out': 0, 'dropped': {}})
+
+    def rows_in(self, step, n):
+        self._step(step)['in'] += int(n)
+
+    def rows_out(self, step, n):
+        self._step(step)['out'] += int(n)
+
+    def drop(self, step, reason, n):
+        if n:
+            dropped = self._step(step)['dropped']
+            dropped[reason] = dropped.get(reason, 0) + int(n)
+
+    def error(self, step, exc):
+        """Exception bị script bắt và chỉ log -> vẫn phải hiện trong báo cáo."""
+        self.errors.append({'step': step, 'type': type(exc).__name__, 'message': str(exc)})
+        self.count('swallowed_exceptions')
+
+    def report(self):
+        return {'stage': self.name, 'started_at': self.started_at, 'phases': self.phases,
+                'counters': self.counters, 'rows': self.rows, 'errors': self.errors}
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+# Recorder hiện hành: các script ghi vào đây qua các hàm module bên dưới
+_current = RunRecorder('default')
+
+def current():
+    return _current
+
+def phase(name):
+    return _current.phase(name)
+
+def count(name, n=1):
+    _current.count(name, n)
+
+def rows_in(step, n):
+    _current.rows_in(step, n)
+
+def rows_out(step, n):
+    _current.rows_out(step, n)
+
+def drop(step, reason, n):
+    _current.drop(step, reason, n)
+
+def error(step, exc):
+    _current.error(step, exc)
+
+@contextmanager
+def stage(name, report_dir=REPORT_DIR, profile=None):
+    """
+    Bao một stage: recorder mới, timer tổng, (tùy chọn) cProfile.
+    Khi kết thúc ghi report_dir/<name>.json và <name>.prof.
+    """
+    global _current
+    previous, _current = _current, RunRecorder(name)
+    profiler = cProfile.Profile() if (PROFILE if profile is None else profile) else None
+    try:
+        with _current.phase('total'):
+            if profiler:
+                profiler.enable()
+            try:
+                yield _current
+            finally:
+                if profiler:
+                    profiler.disable()
+    finally:
+        recorder, _current = _current, previous
+        if report_dir:
+            recorder.write(os.path.join(report_dir, f'{name}.json'))
+            if profiler:
+                profiler.dump_stats(os.path.join(report_dir, f'{name}.prof'))
+            logging.info(f"Run report: {os.path.join(report_dir, name + '.json')}")
\ No newline at end of file
@@ -1,15 +1,37 @@
 # scripts/merge_mirna_expression.py
 import pandas as pd
+import numpy as np
 import os
 from tqdm import tqdm
 import json
 import logging
+from scipy import sparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from expression_store import write_store, store_path_for
+from mirna_ids import normalize_mirna_id, INDEX_VERSION
+from fingerprint import combine_digests
+import instrumentation as ins
 
 # --- CẤU HÌNH ---
 DOWNLOADED_FILES_DIR = 'miRNA_expression' # Thư mục chứa file GDC tải về
 MANIFEST_FILE_PATH = os.path.join(DOWNLOADED_FILES_DIR, 'MANIFEST.txt')
 METADATA_FILE_PATH = os.path.join(DOWNLOADED_FILES_DIR, 'METADATA.json')
 OUTPUT_MATRIX_PATH = 'data/features/mirnas.tsv'
+N_READERS = 8 # Số luồng/process đọc file GDC song song
+USE_PROCESSES = False # True: dùng process pool thay cho thread pool
+EXPORT_TSV = True # Ngoài store nhị phân (mirnas.store/), xuất thêm bản TSV
+# Lọc biểu hiện thấp: giữ miRNA có giá trị > 0 ở ít nhất tỉ lệ này số bệnh nhân (0 = chỉ bỏ dòng toàn 0)
+MIN_EXPRESSED_FRACTION = 0.1
+
+# Merge tăng dần: lưu tổng cộng dồn (ID gốc, chưa chuẩn hóa) + ledger các file đã merge
+INCREMENTAL = True
+MERGE_STATE_DIR = 'data/features/mirnas.merge_state'
+STATE_ACCUMULATOR_FILE = 'accumulator.npz'
+STATE_LEDGER_FILE = 'ledger.tsv'
+STATE_OUTPUT_FILE = 'output.digest' # Tham số đã dùng để ghi output -> đổi tham số thì ghi lại dù không file nào đổi
+STATE_VERSION = 2 # Tăng khi đổi cách đọc/cộng dồn file -> buộc rebuild toàn bộ
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -31,17 +53,222 @@ def create_file_to_patient_map(metadata_path):
         logging.error(f"Error loading metadata: {e}")
         return None
 
-def normalize_mirna_id(mir_id):
-    """Chuẩn hóa ID: hsa-let-7a-1 -> hsa-let-7a, mir -> miR"""
-    # 1. Chuyển 'mir' thành 'miR' (chuẩn chung)
-    new_id = mir_id.replace('mir', 'miR')
-    # 2. Bỏ hậu tố số bản sao (-1, -2)
-    parts = new_id.split('-')
-    if parts[-1].isdigit():
-        new_id = '-'.join(parts[:-1])
-    return new_id
-
-def merge_mirna_files(data_dir, manifest_path, metadata_path, output_path):
+def read_quantification(file_path):
+    """Đọc 1 file GDC -> (miRNA IDs, RPM values, lỗi). Không raise để worker không làm hỏng cả batch."""
+    try:
+        df = pd.read_csv(file_path, sep='\t', usecols=['miRNA_ID', 'reads_per_million_miRNA_mapped'],
+                         dtype={'miRNA_ID': str, 'reads_per_million_miRNA_mapped': np.float64})
+        if df['miRNA_ID'].duplicated().any():
+            raise ValueError("duplicated miRNA_ID rows")
+        return df['miRNA_ID'].to_numpy(), df['reads_per_million_miRNA_mapped'].to_numpy(), None
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+
+def read_quantification_files(file_paths, n_readers=N_READERS, use_processes=USE_PROCESSES):
+    """
+    Đọc song song các file GDC, trả kết quả theo đúng thứ tự đầu vào.
+    Số file đang đọc dở được giới hạn -> bộ nhớ không phụ thuộc vào số file.
+    """
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    window = max(1, n_readers) * 4
+    with executor_cls(max_workers=max(1, n_readers)) as pool:
+        pending = deque()
+        for file_path in file_paths:
+            pending.append(pool.submit(read_quantification, file_path))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+class MirnaAccumulator:
+    """
+    Cộng dồn dạng thưa: mỗi bệnh nhân giữ các khối (cột miRNA, giá trị khác 0) của từng file + số file.
+    Index miRNA cố định theo thứ tự xuất hiện, chỉ nới rộng khi gặp ID mới.
+    Lưu ID gốc (chưa chuẩn hóa) -> có thể lưu lại và cộng dồn tiếp ở lần chạy sau.
+    """
+    def __init__(self, mirna_ids=(), entries=None, counts=None):
+        self.mirna_rows = {m: i for i, m in enumerate(mirna_ids)}
+        self.entries = entries if entries is not None else {} # bệnh nhân -> [(cột int32, giá trị), ...]
+        self.counts = counts if counts is not None else {}    # bệnh nhân -> số file
+
+    @property
+    def n_files(self):
+        return int(sum(self.counts.values()))
+
+    @property
+    def patients(self):
+        return pd.Index(sorted(p for p, count in self.counts.items() if count > 0))
+
+    def add_patients(self, patients):
+        for patient_id in patients:
+            self.counts.setdefault(patient_id, 0)
+            self.entries.setdefault(patient_id, [])
+
+    def reset_patients(self, patients):
+        """Xóa phần cộng dồn của các bệnh nhân (trước khi đọc lại toàn bộ file của họ)."""
+        for patient_id in patients:
+            if patient_id in self.counts:
+                self.counts[patient_id] = 0
+                self.entries[patient_id] = []
+
+    def _columns_for(self, mirna_ids):
+        for m in mirna_ids:
+            if m not in self.mirna_rows:
+                self.mirna_rows[m] = len(self.mirna_rows)
+        return np.fromiter((self.mirna_rows[m] for m in mirna_ids), dtype=np.int32, count=len(mirna_ids))
+
+    def add(self, patient_id, mirna_ids, values):
+        # miRNA thiếu trong file (hoặc NaN) được tính là 0 (giống fillna(0) trước khi lấy trung bình) -> không lưu
+        self.add_patients([patient_id])
+        columns = self._columns_for(mirna_ids)
+        values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+        nonzero = values != 0
+        self.entries[patient_id].append((columns[nonzero], values[nonzero]))
+        self.counts[patient_id] += 1
+
+    def to_sparse(self):
+        """(CSR miRNA x bệnh nhân = trung bình các file của cùng bệnh nhân, ID miRNA, bệnh nhân)."""
+        patients = self.patients
+        rows, cols, vals = [], [], []
+        for row, patient_id in enumerate(patients):
+            for columns, values in self.entries[patient_id]:
+                rows.append(np.full(len(columns), row, dtype=np.int32))
+                cols.append(columns)
+                vals.append(values)
+        concat = lambda parts, dtype: np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+        # COO -> CSR cộng các giá trị trùng (nhiều file của cùng bệnh nhân)
+        by_patient = sparse.csr_matrix((concat(vals, np.float64), (concat(rows, np.int32), concat(cols, np.int32))),
+                                       shape=(len(patients), len(self.mirna_rows)))
+        counts = np.array([self.counts[p] for p in patients], dtype=np.float64)
+        by_patient.data /= np.repeat(counts, np.diff(by_patient.indptr))
+        return by_patient.T.tocsr(), pd.Index(list(self.mirna_rows), name='miRNA_ID'), patients
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        patients = list(self.counts)
+        blocks = [(i, columns, values) for i, p in enumerate(patients) for columns, values in self.entries[p]]
+        np.savez(tmp_path, patients=np.array(patients, dtype=str), mirna_ids=np.array(list(self.mirna_rows), dtype=str),
+                 counts=np.array([self.counts[p] for p in patients], dtype=np.int64),
+                 block_patient=np.array([b[0] for b in blocks], dtype=np.int64),
+                 block_sizes=np.array([len(b[1]) for b in blocks], dtype=np.int64),
+                 columns=np.concatenate([b[1] for b in blocks]) if blocks else np.empty(0, dtype=np.int32),
+                 values=np.concatenate([b[2] for b in blocks]) if blocks else np.empty(0),
+                 version=STATE_VERSION)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            if int(state['version']) != STATE_VERSION:
+                raise ValueError(f"state version {int(state['version'])} != {STATE_VERSION}")
+            patients = state['patients'].tolist()
+            entries = {p: [] for p in patients}
+            bounds = np.cumsum(state['block_sizes'])[:-1]
+            for i, columns, values in zip(state['block_patient'], np.split(state['columns'], bounds), np.split(state['values'], bounds)):
+                entries[patients[i]].append((columns, values))
+            return cls(state['mirna_ids'].tolist(), entries, dict(zip(patients, state['counts'].tolist())))
+
+def aggregate_rows(matrix, labels):
+    """Trung bình các dòng cùng nhãn trên ma trận thưa (như groupby(level=0).mean(), nhãn sắp xếp tăng dần)."""
+    groups, inverse = np.unique(np.asarray(labels, dtype=object), return_inverse=True)
+    members = sparse.csr_matrix((np.ones(len(labels)), (inverse, np.arange(len(labels)))), shape=(len(groups), len(labels)))
+    summed = (members @ matrix).tocsr()
+    summed.data /= np.repeat(np.bincount(inverse, minlength=len(groups)).astype(np.float64), np.diff(summed.indptr))
+    return pd.Index(groups, name='miRNA_ID'), summed
+
+def collect_tasks(manifest_df, data_dir, file_to_patient_map):
+    """Các file sẽ được merge: có trên đĩa và map được sang bệnh nhân. Kèm key + checksum cho ledger."""
+    tasks, skipped = [], {'missing file': 0, 'no patient mapping': 0}
+    for _, row in manifest_df.iterrows():
+        file_name = row['filename']
+        file_path = os.path.join(data_dir, file_name)
+        if not os.path.exists(file_path):
+            skipped['missing file'] += 1
+            continue
+        patient_id = file_to_patient_map.get(os.path.basename(file_name))
+        if not patient_id:
+            skipped['no patient mapping'] += 1
+            continue
+        # GDC manifest có cột id (UUID) + md5; thiếu thì dùng tên file + size/mtime
+        file_key = row['id'] if 'id' in row and pd.notna(row['id']) else file_name
+        if 'md5' in row and pd.notna(row['md5']):
+            checksum = row['md5']
+        else:
+            stat = os.stat(file_path)
+            checksum = f"{stat.st_size}:{int(stat.st_mtime)}"
+        tasks.append({'file_key': file_key, 'checksum': checksum, 'file_path': file_path, 'patient_id': patient_id})
+    for reason, count in skipped.items():
+        ins.drop('manifest', reason.replace(' ', '_'), count)
+        if count: logging.warning(f"Skipped {count} manifest entries: {reason}.")
+    ins.rows_in('manifest', len(manifest_df)); ins.rows_out('manifest', len(tasks))
+    return tasks
+
+def output_digest(output_path):
+    """Các thiết lập quyết định nội dung output (lọc, chuẩn hóa ID, định dạng ghi)."""
+    return combine_digests(STATE_VERSION, INDEX_VERSION, MIN_EXPRESSED_FRACTION, EXPORT_TSV, os.path.abspath(output_path))
+
+def output_up_to_date(state_dir, output_path):
+    """Output tồn tại và được ghi với đúng các thiết lập hiện tại."""
+    digest_path = os.path.join(state_dir, STATE_OUTPUT_FILE)
+    if not os.path.exists(digest_path) or not os.path.exists(store_path_for(output_path)):
+        return False
+    if EXPORT_TSV and not os.path.exists(output_path):
+        return False
+    with open(digest_path) as f:
+        return f.read().strip() == output_digest(output_path)
+
+def load_merge_state(state_dir):
+    """(accumulator, ledger) của lần merge trước, hoặc (None, {}) nếu chưa có / không dùng được."""
+    accumulator_path = os.path.join(state_dir, STATE_ACCUMULATOR_FILE)
+    ledger_path = os.path.join(state_dir, STATE_LEDGER_FILE)
+    if not (os.path.exists(accumulator_path) and os.path.exists(ledger_path)):
+        return None, {}
+    try:
+        accumulator = MirnaAccumulator.load(accumulator_path)
+        ledger_df = pd.read_csv(ledger_path, sep='\t', dtype=str)
+        ledger = {row['file_key']: row for row in ledger_df.to_dict('records')}
+        return accumulator, ledger
+    except Exception as e:
+        logging.warning(f"Merge state unusable ({e}); doing a full rebuild.")
+        return None, {}
+
+def save_merge_state(state_dir, accumulator, ledger, digest):
+    """Chỉ gọi sau khi output đã ghi xong -> lỗi khi ghi thì lần sau vẫn thấy cần merge lại."""
+    os.makedirs(state_dir, exist_ok=True)
+    accumulator.save(os.path.join(state_dir, STATE_ACCUMULATOR_FILE))
+    ledger_path = os.path.join(state_dir, STATE_LEDGER_FILE)
+    columns = ['file_key', 'checksum', 'file_path', 'patient_id']
+    pd.DataFrame(list(ledger.values()), columns=columns).to_csv(ledger_path + '.tmp', sep='\t', index=False)
+    os.replace(ledger_path + '.tmp', ledger_path)
+    digest_path = os.path.join(state_dir, STATE_OUTPUT_FILE)
+    with open(digest_path + '.tmp', 'w') as f:
+        f.write(digest)
+    os.replace(digest_path + '.tmp', digest_path)
+
+def plan_incremental(tasks, accumulator, ledger):
+    """
+    So manifest hiện tại với ledger:
+    - File mới -> chỉ cần cộng thêm.
+    - File đổi checksum / bị bỏ khỏi manifest -> đọc lại toàn bộ file của bệnh nhân đó.
+    """
+    current = {task['file_key']: task for task in tasks}
+    dirty_patients = set()
+    for file_key, entry in ledger.items():
+        task = current.get(file_key)
+        if task is None or task['checksum'] != entry['checksum'] or task['patient_id'] != entry['patient_id']:
+            dirty_patients.add(entry['patient_id'])
+            if task is not None:
+                dirty_patients.add(task['patient_id'])
+
+    accumulator.reset_patients(dirty_patients)
+    kept_ledger = {k: v for k, v in ledger.items() if k in current and v['patient_id'] not in dirty_patients
+                   and current[k]['checksum'] == v['checksum']}
+    to_read = [task for task in tasks if task['file_key'] not in kept_ledger]
+    logging.info(f"Incremental merge: {len(kept_ledger)} files up to date, {len(to_read)} to read "
+                 f"({len(dirty_patients)} patients recomputed).")
+    return to_read, kept_ledger, dirty_patients
+
+def merge_mirna_files(data_dir, manifest_path, metadata_path, output_path, incremental=INCREMENTAL, state_dir=MERGE_STATE_DIR):
     logging.info("Starting miRNA file merge process...")
     file_to_patient_map = create_file_to_patient_map(metadata_path)
     if not file_to_patient_map: return
@@ -49,49 +276,75 @@ def merge_mirna_files(data_dir, manifest_path, metadata_path, output_path):
     try:
         manifest_df = pd.read_csv(manifest_path, sep='\t')
     except Exception as e:
+        ins.error('read_manifest', e)
         logging.error(f"Manifest error: {e}")
         return
 
-    all_mirna_series = []
-    for _, row in tqdm(manifest_df.iterrows(), total=manifest_df.shape[0], desc="Processing files"):
-        file_name = row['filename']
-        file_path = os.path.join(data_dir, file_name)
-        
-        if not os.path.exists(file_path): continue
-        
-        patient_id = file_to_patient_map.get(os.path.basename(file_name))
-        if not patient_id: continue
+    tasks = collect_tasks(manifest_df, data_dir, file_to_patient_map)
+
+    accumulator, ledger = load_merge_state(state_dir) if incremental else (None, {})
+    if accumulator is None:
+        accumulator, ledger, to_read = MirnaAccumulator(), {}, tasks
+    else:
+        to_read, ledger, dirty_patients = plan_incremental(tasks, accumulator, ledger)
+        if not to_read and not dirty_patients and output_up_to_date(state_dir, output_path):
+            logging.info("miRNA matrix already up to date.")
+            return
+    accumulator.add_patients(task['patient_id'] for task in to_read)
 
-        try:
-            df = pd.read_csv(file_path, sep='\t', usecols=['miRNA_ID', 'reads_per_million_miRNA_mapped'], index_col='miRNA_ID')
-            series = df['reads_per_million_miRNA_mapped']
-            series.name = patient_id
-            all_mirna_series.append(series)
-        except Exception:
-            pass
+    failed = []
+    with ins.phase('read_files'):
+        parsed = read_quantification_files([task['file_path'] for task in to_read])
+        for task, (mirna_ids, values, error) in tqdm(zip(to_read, parsed), total=len(to_read), desc="Processing files"):
+            if error:
+                failed.append((task['file_path'], error)) # Không vào ledger -> lần sau đọc lại
+                continue
+            accumulator.add(task['patient_id'], mirna_ids, values)
+            ledger[task['file_key']] = task
+    ins.rows_in('files', len(to_read)); ins.rows_out('files', len(to_read) - len(failed))
+    ins.drop('files', 'parse_error', len(failed))
 
-    if not all_mirna_series:
+    if failed:
+        logging.warning(f"{len(failed)} files failed to parse and were excluded:")
+        for file_path, error in failed:
+            logging.warning(f"   > {file_path}: {error}")
+
+    if accumulator.n_files == 0:
         logging.error("No data processed.")
         return
 
     logging.info("Merging matrix...")
-    final_matrix = pd.concat(all_mirna_series, axis=1).fillna(0)
-    
-    # Gom nhóm các bệnh nhân trùng lặp (nếu có)
-    final_matrix = final_matrix.groupby(final_matrix.columns, axis=1).mean()
+    # Bệnh nhân trùng lặp đã được lấy trung bình trong accumulator (sum / count), vẫn ở dạng thưa
+    matrix, mirna_ids, patients = accumulator.to_sparse()
+    ins.rows_in('mirnas', len(mirna_ids))
     
     # --- BƯỚC CHUẨN HÓA QUAN TRỌNG ---
     logging.info("Normalizing miRNA IDs (Stem -> Base)...")
-    final_matrix.index = final_matrix.index.map(normalize_mirna_id)
-    # Gom nhóm các dòng trùng tên sau khi chuẩn hóa (VD: let-7a-1 và let-7a-2 -> let-7a)
-    final_matrix = final_matrix.groupby(final_matrix.index).mean()
+    with ins.phase('normalize_ids'):
+        # Gom nhóm các dòng trùng tên sau khi chuẩn hóa (VD: let-7a-1 và let-7a-2 -> let-7a)
+        mirna_ids, matrix = aggregate_rows(matrix, mirna_ids.map(normalize_mirna_id))
+    ins.drop('mirnas', 'merged_after_normalization', len(accumulator.mirna_rows) - len(mirna_ids))
     
-    # Lọc các dòng toàn 0
-    final_matrix = final_matrix.loc[(final_matrix.sum(axis=1) > 0)]
+    # Lọc trên dạng thưa: dòng toàn 0, dòng biểu hiện ở quá ít bệnh nhân
+    n_expressed = np.diff((matrix > 0).tocsr().indptr)
+    not_zero = np.asarray(matrix.sum(axis=1)).ravel() > 0
+    keep = not_zero & (n_expressed >= MIN_EXPRESSED_FRACTION * len(patients))
+    ins.drop('mirnas', 'all_zero', (~not_zero).sum())
+    ins.drop('mirnas', 'low_expression', (not_zero & ~keep).sum())
+    ins.rows_out('mirnas', keep.sum())
 
+    # Chỉ các dòng còn lại mới chuyển sang dense
+    final_matrix = pd.DataFrame(matrix[np.flatnonzero(keep)].toarray(), index=mirna_ids[keep], columns=patients)
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    final_matrix.to_csv(output_path, sep='\t', index_label='miRNA_ID')
-    logging.info(f"Saved merged data to {output_path}. Shape: {final_matrix.shape}")
+    with ins.phase('write_matrix'):
+        if EXPORT_TSV:
+            final_matrix.to_csv(output_path, sep='\t', index_label='miRNA_ID')
+            logging.info(f"Saved merged data to {output_path}. Shape: {final_matrix.shape}")
+        # Ghi store sau TSV -> store luôn mới hơn, các script đọc store thay vì parse text
+        write_store(final_matrix, store_path_for(output_path))
+    if incremental:
+        save_merge_state(state_dir, accumulator, ledger, output_digest(output_path))
 
 if __name__ == "__main__":
-    merge_mirna_files(DOWNLOADED_FILES_DIR, MANIFEST_FILE_PATH, METADATA_FILE_PATH, OUTPUT_MATRIX_PATH)
\ No newline at end of file
+    with ins.stage('merge_mirna'):
+        merge_mirna_files(DOWNLOADED_FILES_DIR, MANIFEST_FILE_PATH, METADATA_FILE_PATH, OUTPUT_MATRIX_PATH)
\ No newline at end of file
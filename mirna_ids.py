@@ -0,0 +1,116 @@
+# scripts/mirna_ids.py
+import numpy as np
+import pandas as pd
+import os
+import re
+import logging
+
+from expression_store import read_expression_ids, has_fresh_store, store_path_for, ROWS_FILE
+from fingerprint import file_digest, combine_digests
+
+# --- CẤU HÌNH ---
+ID_CACHE_DIR = 'data/cache/mirna_ids'
+CORE_PATTERN = r'(?:mir|let)-[0-9a-z]+' # Core Name: mir-122, let-7a
+INDEX_VERSION = 1 # Tăng khi đổi quy tắc chuẩn hóa / regex -> cache cũ tự bị bỏ qua
+
+def normalize_mirna_id(mir_id):
+    """
+    Chuẩn hóa ID: 
+    1. hsa-let-7a-1 -> hsa-let-7a (Bỏ hậu tố copy number)
+    2. hsa-mir-122 -> hsa-miR-122 (Chuẩn hóa chữ hoa/thường)
+    """
+    # Chuyển 'mir' thành 'miR' (theo chuẩn TargetScan/miRBase)
+    new_id = mir_id.replace('mir', 'miR')
+    # Bỏ hậu tố số bản sao (-1, -2) nếu có
+    parts = new_id.split('-')
+    if parts[-1].isdigit():
+        new_id = '-'.join(parts[:-1])
+    return new_id
+
+def mirna_cores(ids):
+    """Core Name (chữ thường) cho từng ID: hsa-miR-122-5p -> mir-122. Không khớp -> NaN."""
+    ids = pd.Series(ids, dtype=object)
+    return ids.str.extract(f'({CORE_PATTERN})', flags=re.IGNORECASE, expand=False).str.lower()
+
+class MirnaIdIndex:
+    """
+    Bảng tra đã tính sẵn: mature ID -> core -> dòng precursor trong ma trận biểu hiện.
+    Mọi bước đều là số nguyên (-1 = không có) -> tra cứu bằng indexing, không regex theo dòng.
+    """
+    def __init__(self, expression_ids, mature_ids, mature_core, cores, core_row):
+        self.expression_ids = pd.Index(expression_ids, dtype=object)
+        self.mature_ids = pd.Index(mature_ids, dtype=object)
+        self.mature_core = np.asarray(mature_core, dtype=np.int64)
+        self.cores = pd.Index(cores, dtype=object)
+        self.core_row = np.asarray(core_row, dtype=np.int64)
+
+    @classmethod
+    def build(cls, expression_ids, mature_ids):
+        expression_ids = pd.Index(expression_ids, dtype=object)
+        mature_ids = pd.Index(pd.unique(pd.Series(mature_ids, dtype=object).dropna()), dtype=object)
+
+        # Core -> dòng precursor (nhiều dòng cùng core: dòng sau cùng thắng, như expr_map cũ)
+        expr_cores = mirna_cores(expression_ids)
+        core_to_row = pd.Series(np.arange(len(expression_ids)), index=expr_cores.to_numpy())
+        core_to_row = core_to_row[core_to_row.index.notna()]
+        core_to_row = core_to_row[~core_to_row.index.duplicated(keep='last')]
+
+        mature_core_names = mirna_cores(mature_ids)
+        cores = pd.Index(pd.unique(pd.concat([mature_core_names, pd.Series(core_to_row.index)]).dropna()), dtype=object)
+        mature_core = cores.get_indexer(mature_core_names)
+        core_row = core_to_row.reindex(cores).fillna(-1).to_numpy(dtype=np.int64)
+        return cls(expression_ids, mature_ids, mature_core, cores, core_row)
+
+    def mature_rows(self):
+        """Dòng precursor của từng mature ID trong self.mature_ids (-1 nếu không có)."""
+        return np.where(self.mature_core >= 0, self.core_row[self.mature_core], -1)
+
+    def precursor_rows(self, mature_ids):
+        """Vector: mature ID bất kỳ -> dòng precursor (-1 nếu không có core / không có biểu hiện)."""
+        codes = self.mature_ids.get_indexer(pd.Index(mature_ids, dtype=object))
+        rows = self.mature_rows()
+        return np.where(codes >= 0, rows[codes], -1)
+
+    def matches(self, expression_ids):
+        return self.expression_ids.equals(pd.Index(expression_ids, dtype=object))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz" # Tên tạm riêng cho từng process (nhiều cohort cùng build)
+        np.savez(tmp_path, expression_ids=np.array(self.expression_ids, dtype=str), mature_ids=np.array(self.mature_ids, dtype=str),
+                 mature_core=self.mature_core, cores=np.array(self.cores, dtype=str), core_row=self.core_row)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['expression_ids'].tolist(), data['mature_ids'].tolist(), data['mature_core'],
+                       data['cores'].tolist(), data['core_row'])
+
+def expression_fingerprint(expression_path):
+    """Chỉ thứ tự/ID dòng quan trọng: dùng rows.txt của store nếu có, không thì hash cả file."""
+    if has_fresh_store(expression_path):
+        return file_digest(os.path.join(store_path_for(expression_path), ROWS_FILE))
+    return file_digest(expression_path)
+
+def load_id_index(expression_path, interaction_paths, expression_ids=None, cache_dir=ID_CACHE_DIR):
+    """
+    Bảng tra ID dùng chung cho mọi script, cache trên đĩa theo hash của file đầu vào.
+    expression_ids: ID dòng đã nạp sẵn (nếu có) -> dùng để kiểm tra cache khớp thứ tự dòng.
+    """
+    key = combine_digests(INDEX_VERSION, expression_fingerprint(expression_path),
+                          *(file_digest(p) for p in interaction_paths))
+    cache_path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(cache_path):
+        index = MirnaIdIndex.load(cache_path)
+        if expression_ids is None or index.matches(expression_ids):
+            return index
+
+    logging.info("Building miRNA ID index...")
+    if expression_ids is None:
+        expression_ids = read_expression_ids(expression_path)
+    mature_ids = pd.concat([pd.read_csv(p, usecols=['mirna_id'], dtype=str)['mirna_id'] for p in interaction_paths])
+    index = MirnaIdIndex.build(expression_ids, mature_ids)
+    index.save(cache_path)
+    logging.info(f"miRNA ID index: {len(index.mature_ids)} mature IDs, {int((index.core_row >= 0).sum())} cores with expression.")
+    return index
@@ -0,0 +1,271 @@
+# scripts/pipeline.py
+import argparse
+import importlib
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from fingerprint import file_digest, combine_digests
+from edge_writer import metadata_path_for
+import instrumentation as ins
+
+import pre_process
+import merge_mirna_expression
+import qick_fix
+import build_mirna_gene_edges
+import ensemble_transfer
+import gene_resolver
+
+# --- CẤU HÌNH ---
+STATE_PATH = 'data/.pipeline_state.json'
+MAX_JOBS = 2 # Số stage độc lập chạy song song (tiền xử lý tương tác // merge miRNA)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class Stage:
+    """
+    Một bước của pipeline: hàm module.func, file vào/ra và tham số ảnh hưởng tới kết quả.
+    params được gán vào module cấu hình (config, mặc định = module) trước khi chạy
+    -> cũng là một phần của fingerprint.
+    """
+    def __init__(self, name, module, func, inputs, outputs, params=None, args=(), config=None):
+        self.name = name
+        self.module = module
+        self.func = func
+        self.config = config or module
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = dict(params or {})
+        self.args = tuple(args)
+
+def build_stages(with_quick_fix=False, overrides=None):
+    """
+    DAG theo thứ tự topo: mỗi input do stage khai báo trước nó tạo ra (nếu có) là một cạnh phụ thuộc.
+    overrides (--set) chỉ dùng để chọn input phụ thuộc tham số (EDGE_ENSEMBL_COLUMN -> index gene).
+    """
+    pp, mm, be, et = pre_process, merge_mirna_expression, build_mirna_gene_edges, ensemble_transfer
+    # Index symbol -> Ensembl (SQLite, gồm cả kết quả remote đã cache) + file dump HGNC nạp vào nó
+    resolver_inputs = [gene_resolver.RESOLVER_DB_PATH, gene_resolver.HGNC_DUMP_PATH]
+    edge_ensembl = (overrides or {}).get('EDGE_ENSEMBL_COLUMN', be.EDGE_ENSEMBL_COLUMN)
+    mir_outputs = [mm.OUTPUT_MATRIX_PATH, os.path.splitext(mm.OUTPUT_MATRIX_PATH)[0] + '.store']
+    stages = [
+        Stage('preprocess_mirtarbase', 'pre_process', 'preprocess_mirtarbase',
+              inputs=[pp.MI_RTARBASE_RAW_PATH], outputs=[pp.MI_RTARBASE_PROCESSED_PATH],
+              args=(pp.MI_RTARBASE_RAW_PATH, pp.MI_RTARBASE_PROCESSED_PATH)),
+        Stage('preprocess_targetscan', 'pipeline', 'run_preprocess_targetscan',
+              inputs=[pp.TARGETSCAN_RAW_PATH, pp.FAMILY_INFO_PATH], outputs=[pp.TARGETSCAN_PROCESSED_PATH],
+              params={'TARGETSCAN_SPECIES_ID': pp.TARGETSCAN_SPECIES_ID}, config='pre_process'),
+        # Manifest chứa md5 từng file GDC -> đủ làm fingerprint cho cả thư mục
+        Stage('merge_mirna', 'merge_mirna_expression', 'merge_mirna_files',
+              inputs=[mm.MANIFEST_FILE_PATH, mm.METADATA_FILE_PATH], outputs=mir_outputs,
+              params={'MIN_EXPRESSED_FRACTION': mm.MIN_EXPRESSED_FRACTION},
+              args=(mm.DOWNLOADED_FILES_DIR, mm.MANIFEST_FILE_PATH, mm.METADATA_FILE_PATH, mm.OUTPUT_MATRIX_PATH)),
+    ]
+    if with_quick_fix:
+        stages.append(Stage('quick_fix', 'qick_fix', 'fix_existing_matrix',
+                            inputs=[qick_fix.INPUT_PATH], outputs=[qick_fix.OUTPUT_PATH]))
+    stages += [
+        Stage('build_edges', 'build_mirna_gene_edges', 'build_edges',
+              inputs=[be.GENE_PATH, be.MIR_PATH, be.MIRTAR_PATH, be.TARGET_PATH] + (resolver_inputs if edge_ensembl else []),
+              outputs=[be.OUTPUT_PATH, metadata_path_for(be.OUTPUT_PATH)],
+              params={k: getattr(be, k) for k in ('P_THRESH', 'R_THRESH', 'BONUS', 'ASSOCIATION', 'SIGNIFICANCE', 'N_PERMUTATIONS',
+                                                  'PERMUTATION_SEED', 'EDGE_ENSEMBL_COLUMN')}),
+        Stage('ensembl_transfer', 'ensemble_transfer', 'convert_edge_file_to_ensembl',
+              inputs=[et.INPUT_EDGES_PATH] + resolver_inputs, outputs=[et.OUTPUT_EDGES_PATH],
+              params={'MANUAL_CORRECTION_MAP': et.MANUAL_CORRECTION_MAP},
+              args=(et.INPUT_EDGES_PATH, et.OUTPUT_EDGES_PATH)),
+    ]
+    return stages
+
+def run_preprocess_targetscan():
+    if not os.path.exists(pre_process.FAMILY_INFO_PATH):
+        raise FileNotFoundError(pre_process.FAMILY_INFO_PATH)
+    fam_map = pre_process.load_family_mapping(pre_process.FAMILY_INFO_PATH)
+    pre_process.preprocess_targetscan(pre_process.TARGETSCAN_RAW_PATH, pre_process.TARGETSCAN_PROCESSED_PATH, fam_map,
+                                      species_id=pre_process.TARGETSCAN_SPECIES_ID)
+
+def upstream_of(stages):
+    """stage -> {input path: tên stage tạo ra file đó (stage gần nhất phía trước)}."""
+    producers, upstream = {}, {}
+    for stage in stages:
+        upstream[stage.name] = {path: producers[path] for path in stage.inputs if path in producers}
+        for path in stage.outputs:
+            producers[path] = stage.name
+    return upstream
+
+def compute_fingerprints(stages):
+    """
+    Fingerprint = tham số + với mỗi input: fingerprint của stage tạo ra nó, hoặc hash nội dung nếu là file nguồn.
+    Đổi P_THRESH chỉ làm đổi fingerprint của build_edges và các stage phía sau.
+    """
+    upstream = upstream_of(stages)
+    fingerprints = {}
+    for stage in stages:
+        parts = [stage.name, json.dumps(stage.params, sort_keys=True, default=str)]
+        for path in stage.inputs:
+            if path in upstream[stage.name]:
+                parts.append((path, fingerprints[upstream[stage.name][path]]))
+            else:
+                parts.append((path, file_digest(path) if os.path.exists(path) else None))
+        fingerprints[stage.name] = combine_digests(*parts)
+    return fingerprints
+
+def load_state(path=STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(state, path=STATE_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+class _ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def set_aside_outputs(stage):
+    """
+    Đổi tên output cũ thành <path>.prev trước khi chạy -> output còn lại sau stage chắc chắn do lần chạy này ghi
+    (script không ghi gì chỉ log cảnh báo). Output đồng thời là input (qick_fix ghi đè chính nó) thì giữ nguyên.
+    """
+    moved = []
+    for path in stage.outputs:
+        if path not in stage.inputs and os.path.exists(path):
+            _remove_path(path + '.prev')
+            os.replace(path, path + '.prev')
+            moved.append(path)
+    return moved
+
+def restore_outputs(moved, failed):
+    """Stage lỗi -> trả lại output cũ (thay phần ghi dở); thành công -> xóa bản .prev."""
+    for path in moved:
+        if failed:
+            _remove_path(path)
+            os.replace(path + '.prev', path)
+        else:
+            _remove_path(path + '.prev')
+
+def execute_stage(stage, profile=False):
+    """
+    Chạy trong worker process. Các script tự bắt lỗi và chỉ log -> stage thất bại nếu
+    có log ERROR hoặc thiếu output (output cũ được để sang bên trong lúc chạy, không tính).
+    Báo cáo chạy: ins.REPORT_DIR/<stage>.json.
+    """
+    config = importlib.import_module(stage.config)
+    for key, value in stage.params.items():
+        setattr(config, key, value)
+
+    errors = _ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    start = time.time()
+    moved = set_aside_outputs(stage)
+    failed = True
+    try:
+        with ins.stage(stage.name, profile=profile):
+            getattr(importlib.import_module(stage.module), stage.func)(*stage.args)
+        if errors.messages:
+            raise RuntimeError(errors.messages[-1])
+        missing = [p for p in stage.outputs if not os.path.exists(p)]
+        if missing:
+            raise RuntimeError(f"stage did not produce {missing}")
+        failed = False
+    finally:
+        logging.getLogger().removeHandler(errors)
+        restore_outputs(moved, failed)
+    return time.time() - start
+
+def run_pipeline(with_quick_fix=False, force=(), jobs=MAX_JOBS, overrides=None, dry_run=False, profile=False):
+    stages = build_stages(with_quick_fix, overrides)
+    for stage in stages:
+        for key, value in (overrides or {}).items():
+            if key in stage.params:
+                stage.params[key] = value
+    by_name = {stage.name: stage for stage in stages}
+    upstream = upstream_of(stages)
+    fingerprints = compute_fingerprints(stages)
+    state = load_state()
+
+    # Stage cần chạy: fingerprint đổi, thiếu output, bị ép chạy, hoặc có stage phía trước phải chạy lại
+    todo = set()
+    for stage in stages:
+        record = state.get(stage.name, {})
+        stale = (record.get('fingerprint') != fingerprints[stage.name]
+                 or not all(os.path.exists(p) for p in stage.outputs)
+                 or stage.name in force
+                 or any(dep in todo for dep in upstream[stage.name].values()))
+        if stale:
+            todo.add(stage.name)
+        logging.info(f"[{'RUN ' if stale else 'SKIP'}] {stage.name}")
+    if dry_run or not todo:
+        return todo
+
+    done, failed, running = set(), set(), {}
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while len(done) + len(failed) < len(todo):
+            for name in [s.name for s in stages if s.name in todo]:
+                deps = set(upstream[name].values()) & todo
+                if name in done or name in failed or name in running.values():
+                    continue
+                if deps & failed:
+                    failed.add(name)
+                    logging.error(f"[SKIPPED] {name}: upstream stage failed.")
+                elif deps <= done:
+                    running[pool.submit(execute_stage, by_name[name], profile)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    failed.add(name)
+                    logging.error(f"[FAILED] {name}: {e}")
+                    continue
+                done.add(name)
+                # Tính lại sau khi chạy: stage có thể tự cập nhật input (resolver ghi kết quả remote vào index)
+                # -> lưu fingerprint của input mà output thực sự dùng, lần sau không chạy lại vô ích
+                state[name] = {'fingerprint': compute_fingerprints(stages)[name], 'seconds': round(seconds, 2),
+                               'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                save_state(state)
+                logging.info(f"[DONE] {name} ({seconds:.1f}s)")
+
+    if failed:
+        logging.error(f"Pipeline finished with failures: {sorted(failed)}")
+    return todo
+
+def _parse_override(text):
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the miRNA-gene pipeline, skipping stages whose inputs are unchanged.")
+    parser.add_argument('--with-quick-fix', action='store_true', help="Run qick_fix on mirnas.tsv after merging")
+    parser.add_argument('--force', nargs='*', default=[], help="Stage names to rerun regardless of fingerprint")
+    parser.add_argument('--jobs', type=int, default=MAX_JOBS)
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='KEY=VALUE',
+                        help="Override a stage parameter, e.g. --set P_THRESH=0.01")
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--profile', action='store_true', help="Dump a cProfile file per stage next to its run report")
+    args = parser.parse_args()
+    run_pipeline(args.with_quick_fix, set(args.force), args.jobs, dict(map(_parse_override, args.overrides)), args.dry_run,
+                 args.profile)
\ No newline at end of file
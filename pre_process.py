@@ -1,8 +1,11 @@
 # scripts/pre_process.py
 import pandas as pd
+import numpy as np
 import os
 import logging
 
+import instrumentation as ins
+
 # --- CẤU HÌNH ---
 RAW_DATA_DIR = 'data/raw/'
 MI_RTARBASE_RAW_PATH = os.path.join(RAW_DATA_DIR, 'hsa_MTI_homo.csv')
@@ -13,20 +16,46 @@ PROCESSED_DATA_DIR = 'data/processed/'
 MI_RTARBASE_PROCESSED_PATH = os.path.join(PROCESSED_DATA_DIR, 'mirtarbase_processed.csv')
 TARGETSCAN_PROCESSED_PATH = os.path.join(PROCESSED_DATA_DIR, 'targetscan_processed.csv')
 
+# Đọc file thô theo khối -> trần bộ nhớ cố định bất kể kích thước file (None = đọc cả file)
+STREAM_CHUNK_ROWS = 500000
+MI_RTARBASE_COLUMNS = ['miRNA', 'Species (miRNA)', 'Target Gene']
+TARGETSCAN_COLUMNS = ['miR Family', 'Gene Symbol', 'Species ID']
+TARGETSCAN_SPECIES_ID = 9606 # Chỉ giữ dự đoán trên UTR người (None = giữ tất cả loài)
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def preprocess_mirtarbase(raw_path, processed_path):
+def read_chunks(path, chunk_rows, **read_kwargs):
+    """Đọc file theo từng khối chunk_rows dòng (None = đọc một lần)."""
+    if chunk_rows is None:
+        yield pd.read_csv(path, **read_kwargs)
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_rows, **read_kwargs)
+
+def discard_tmp(processed_path):
+    if os.path.exists(processed_path + '.tmp'):
+        os.remove(processed_path + '.tmp')
+
+def preprocess_mirtarbase(raw_path, processed_path, chunk_rows=STREAM_CHUNK_ROWS):
     logging.info(f"Processing miRTarBase: {raw_path}")
     try:
-        df = pd.read_csv(raw_path)
-        df_human = df[df['Species (miRNA)'] == 'hsa']
-        df_processed = df_human[['miRNA', 'Target Gene']].copy()
-        df_processed.rename(columns={'miRNA': 'mirna_id', 'Target Gene': 'gene_id'}, inplace=True)
-        df_processed.drop_duplicates(inplace=True)
+        seen = PairSet()
         os.makedirs(os.path.dirname(processed_path), exist_ok=True)
-        df_processed.to_csv(processed_path, index=False)
-        logging.info(f"Saved miRTarBase: {len(df_processed)} interactions.")
+        with open(processed_path + '.tmp', 'w', newline='') as out: # Ghi tạm rồi rename -> lỗi giữa chừng không đè file cũ
+            out.write('mirna_id,gene_id\n')
+            # Chỉ đọc 3 cột cần thiết, lọc người (hsa) ngay trên từng khối
+            for chunk in read_chunks(raw_path, chunk_rows, usecols=MI_RTARBASE_COLUMNS, dtype=str):
+                df_human = chunk[chunk['Species (miRNA)'] == 'hsa']
+                df_processed = df_human.rename(columns={'miRNA': 'mirna_id', 'Target Gene': 'gene_id'})[['mirna_id', 'gene_id']]
+                df_processed = df_processed[seen.add_new(df_processed['mirna_id'], df_processed['gene_id'])]
+                df_processed.to_csv(out, index=False, header=False)
+                ins.rows_in('mirtarbase', len(chunk)); ins.rows_out('mirtarbase', len(df_processed))
+                ins.drop('mirtarbase', 'non_human', len(chunk) - len(df_human))
+                ins.drop('mirtarbase', 'duplicate_pair', len(df_human) - len(df_processed))
+        os.replace(processed_path + '.tmp', processed_path)
+        logging.info(f"Saved miRTarBase: {len(seen)} interactions.")
     except Exception as e:
+        discard_tmp(processed_path)
+        ins.error('mirtarbase', e)
         logging.error(f"Error miRTarBase: {e}")
 
 def load_family_mapping(family_info_path):
@@ -42,49 +71,105 @@ def load_family_mapping(family_info_path):
         logging.error(f"Error loading family info: {e}")
         return {}
 
-def preprocess_targetscan(raw_path, processed_path, family_mapping):
+class PairSet:
+    """
+    Tập cặp (mirna_id, gene_id) gọn: mỗi ID được mã hóa thành số nguyên,
+    mỗi cặp là một int64 trong mảng đã sắp xếp (thay cho set tuple của Python).
+    Mỗi khối chỉ tra searchsorted trên mảng đã sắp xếp + chèn phần mới (một lần copy), không sort lại cả tập.
+    """
+    def __init__(self):
+        self.mirna_vocab = pd.Index([], dtype=object)
+        self.gene_vocab = pd.Index([], dtype=object)
+        self.keys = np.array([], dtype=np.int64)
+
+    @staticmethod
+    def _encode(vocab, values):
+        codes = vocab.get_indexer(values)
+        if (codes < 0).any():
+            vocab = vocab.append(pd.Index(pd.unique(values[codes < 0]), dtype=object))
+            codes = vocab.get_indexer(values)
+        return vocab, codes.astype(np.int64)
+
+    def add_new(self, mirna_ids, gene_ids):
+        """Thêm các cặp, trả về mask các dòng lần đầu xuất hiện (giữ dòng đầu tiên)."""
+        self.mirna_vocab, mirna_codes = self._encode(self.mirna_vocab, np.asarray(mirna_ids, dtype=object))
+        self.gene_vocab, gene_codes = self._encode(self.gene_vocab, np.asarray(gene_ids, dtype=object))
+        keys = (mirna_codes << 32) | gene_codes
+
+        pos = np.searchsorted(self.keys, keys)
+        seen = self.keys[np.minimum(pos, len(self.keys) - 1)] == keys if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        is_new = ~pd.Series(keys).duplicated().to_numpy() & ~seen
+        new_keys = np.sort(keys[is_new])
+        self.keys = np.insert(self.keys, np.searchsorted(self.keys, new_keys), new_keys)
+        return is_new
+
+    def __len__(self):
+        return len(self.keys)
+
+def family_table(family_mapping):
+    """Dict Family -> [miRNA] thành bảng 2 cột (giữ thứ tự thành viên trong họ)."""
+    rows = [(family, mirna_id) for family, members in family_mapping.items() for mirna_id in members]
+    return pd.DataFrame(rows, columns=['miR Family', 'mirna_id'])
+
+def expand_families(predictions, families):
+    """
+    Mở rộng họ miRNA theo cột: join 'miR Family' với bảng họ -> một dòng cho mỗi thành viên.
+    Họ không có trong map: thêm 'hsa-' nếu thiếu (và có 'miR'), ngược lại giữ nguyên tên họ.
+    """
+    merged = predictions[['miR Family', 'Gene Symbol']].merge(families, on='miR Family', how='left', sort=False, indicator=True)
+    family = merged['miR Family'].astype(str)
+    fallback = family.where(family.str.startswith('hsa-') | ~family.str.contains('miR', regex=False), 'hsa-' + family)
+    unmapped = (merged['_merge'] == 'left_only').to_numpy()
+    return pd.DataFrame({
+        'mirna_id': np.where(unmapped, fallback, merged['mirna_id']),
+        'gene_id': merged['Gene Symbol'].to_numpy()
+    })
+
+def preprocess_targetscan(raw_path, processed_path, family_mapping, chunk_rows=STREAM_CHUNK_ROWS, species_id=TARGETSCAN_SPECIES_ID):
     logging.info(f"Processing TargetScan with Family Expansion: {raw_path}")
     try:
-        df = pd.read_csv(raw_path, sep='\t')
-        expanded_rows = []
-        unique_pairs = set()
-        
-        for _, row in df.iterrows():
-            family = row['miR Family']
-            gene = row['Gene Symbol']
-            
-            # Tra cứu danh sách con trong họ
-            specific_mirnas = family_mapping.get(family, [])
-            
-            # Nếu không thấy trong map (hiếm), giữ nguyên tên family (có thể sẽ bị lọc sau)
-            if not specific_mirnas:
-                # Cố gắng sửa tên cơ bản nếu thiếu hsa-
-                if not family.startswith('hsa-') and 'miR' in family:
-                    specific_mirnas = ['hsa-' + family]
-                else:
-                    specific_mirnas = [family]
-
-            for mirna_id in specific_mirnas:
-                pair = (mirna_id, gene)
-                if pair not in unique_pairs:
-                    expanded_rows.append({'mirna_id': mirna_id, 'gene_id': gene})
-                    unique_pairs.add(pair)
-
-        df_final = pd.DataFrame(expanded_rows)
+        families = family_table(family_mapping)
+        seen = PairSet()
+
+        # Đọc + mở rộng họ theo từng khối -> bộ nhớ tỉ lệ với chunk_rows, không phải cả file
         os.makedirs(os.path.dirname(processed_path), exist_ok=True)
-        df_final.to_csv(processed_path, index=False)
-        logging.info(f"Saved Expanded TargetScan: {len(df_final)} interactions.")
+        with open(processed_path + '.tmp', 'w', newline='') as out:
+            out.write('mirna_id,gene_id\n')
+            for chunk in read_chunks(raw_path, chunk_rows, sep='\t', dtype=str,
+                                     usecols=lambda c: c in TARGETSCAN_COLUMNS):
+                n_raw = len(chunk)
+                if species_id is not None and 'Species ID' in chunk.columns:
+                    chunk = chunk[chunk['Species ID'] == str(species_id)] # Human only
+                ins.drop('targetscan', 'other_species', n_raw - len(chunk))
+                n_species = len(chunk)
+                chunk = chunk.dropna(subset=['miR Family'])
+                ins.drop('targetscan', 'missing_family', n_species - len(chunk))
+                expanded = expand_families(chunk, families)
+                n_expanded = len(expanded)
+                expanded = expanded[seen.add_new(expanded['mirna_id'], expanded['gene_id'])]
+                expanded.to_csv(out, index=False, header=False)
+                # Mở rộng họ làm tăng số dòng -> ghi riêng số dòng sau mở rộng
+                ins.rows_in('targetscan', n_raw); ins.rows_out('targetscan', len(expanded))
+                ins.count('targetscan_expanded_rows', n_expanded)
+                ins.drop('targetscan', 'duplicate_pair', n_expanded - len(expanded))
+
+        os.replace(processed_path + '.tmp', processed_path)
+        logging.info(f"Saved Expanded TargetScan: {len(seen)} interactions.")
     except Exception as e:
+        discard_tmp(processed_path)
+        ins.error('targetscan', e)
         logging.error(f"Error TargetScan: {e}")
 
 if __name__ == "__main__":
     os.makedirs(RAW_DATA_DIR, exist_ok=True)
     os.makedirs(PROCESSED_DATA_DIR, exist_ok=True)
     
-    preprocess_mirtarbase(MI_RTARBASE_RAW_PATH, MI_RTARBASE_PROCESSED_PATH)
+    with ins.stage('preprocess_mirtarbase'):
+        preprocess_mirtarbase(MI_RTARBASE_RAW_PATH, MI_RTARBASE_PROCESSED_PATH)
     
     if os.path.exists(FAMILY_INFO_PATH):
-        fam_map = load_family_mapping(FAMILY_INFO_PATH)
-        preprocess_targetscan(TARGETSCAN_RAW_PATH, TARGETSCAN_PROCESSED_PATH, fam_map)
+        with ins.stage('preprocess_targetscan'):
+            fam_map = load_family_mapping(FAMILY_INFO_PATH)
+            preprocess_targetscan(TARGETSCAN_RAW_PATH, TARGETSCAN_PROCESSED_PATH, fam_map)
     else:
         logging.error("Missing miR_Family_Info.txt. Cannot expand TargetScan families properly.")
\ No newline at end of file
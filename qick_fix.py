@@ -1,55 +1,113 @@
 # scripts/quick_fix_mirna.py
+import numpy as np
 import pandas as pd
 import os
 import logging
 
+from expression_store import read_expression_header, iter_expression_chunks, StoreWriter, store_path_for
+from mirna_ids import normalize_mirna_id
+import instrumentation as ins
+
 # --- CẤU HÌNH ---
 INPUT_PATH = 'data/features/mirnas.tsv'  # File cũ của bạn
-OUTPUT_PATH = 'data/features/mirnas.tsv' # Ghi đè lại chính nó (hoặc đổi tên nếu muốn backup)
+OUTPUT_PATH = 'data/features/mirnas.tsv' # Ghi đè lại chính nó (ghi file tạm rồi rename -> không hỏng file gốc nếu lỗi giữa chừng)
+CHUNK_ROWS = 10000 # Số dòng đọc / ghi mỗi lần
+
+# 'tsv': ghi TSV (+ cập nhật store nhị phân nếu đã có), 'store': chỉ ghi store (bỏ qua TSV), 'both'
+OUTPUT_FORMAT = 'tsv'
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-def normalize_mirna_id(mir_id):
+def plan_rows(ids):
     """
-    Chuẩn hóa ID: 
-    1. hsa-let-7a-1 -> hsa-let-7a (Bỏ hậu tố copy number)
-    2. hsa-mir-122 -> hsa-miR-122 (Chuẩn hóa chữ hoa/thường)
+    Chuẩn hóa ID (mỗi dòng đúng 1 lần) -> vị trí của từng dòng trong output.
+    Dòng có ID duy nhất giữ thứ tự gốc; các ID bị trùng sau chuẩn hóa (VD: let-7a-1 và let-7a-2 -> let-7a)
+    xếp cuối, theo thứ tự gặp đầu tiên. Trả về (ID output, vị trí output của từng dòng, mask dòng bị trùng).
     """
-    # Chuyển 'mir' thành 'miR' (theo chuẩn TargetScan/miRBase)
-    new_id = mir_id.replace('mir', 'miR')
-    
-    # Bỏ hậu tố số bản sao (-1, -2) nếu có
-    # VD: hsa-let-7a-1 -> hsa-let-7a
-    parts = new_id.split('-')
-    if parts[-1].isdigit():
-        new_id = '-'.join(parts[:-1])
-        
-    return new_id
-
-def fix_existing_matrix():
-    logging.info(f"Reading existing matrix from {INPUT_PATH}...")
+    normalized = np.array([normalize_mirna_id(mir_id) for mir_id in ids], dtype=object)
+    codes, uniques = pd.factorize(normalized)
+    sizes = np.bincount(codes, minlength=len(uniques))
+    colliding = sizes[codes] > 1
+    single = np.flatnonzero(~colliding)
+
+    out_pos = np.empty(len(codes), dtype=np.int64)
+    out_pos[single] = np.arange(len(single))
+    group_rank = np.cumsum(sizes > 1) - 1
+    out_pos[colliding] = len(single) + group_rank[codes[colliding]]
+    out_ids = np.concatenate([normalized[single], np.asarray(uniques, dtype=object)[sizes > 1]])
+    return out_ids, out_pos, colliding
+
+def fix_existing_matrix(input_path=INPUT_PATH, output_path=OUTPUT_PATH, output_format=OUTPUT_FORMAT, chunk_rows=CHUNK_ROWS):
+    logging.info(f"Reading existing matrix from {input_path}...")
     try:
-        # Load dữ liệu cũ
-        df = pd.read_csv(INPUT_PATH, sep='\t', index_col=0)
-        original_count = len(df)
-        
-        logging.info("Normalizing IDs...")
-        # Áp dụng hàm chuẩn hóa cho Index
-        df.index = df.index.map(normalize_mirna_id)
-        
-        # Gom nhóm các dòng bị trùng tên sau khi chuẩn hóa (Lấy trung bình)
-        # VD: let-7a-1 và let-7a-2 giờ cùng tên let-7a -> Gộp lại
-        df = df.groupby(df.index).mean()
-        
-        new_count = len(df)
-        logging.info(f"Done. Reduced from {original_count} to {new_count} unique miRNAs.")
-        
-        # Lưu lại
-        df.to_csv(OUTPUT_PATH, sep='\t')
-        logging.info(f"Saved fixed matrix to {OUTPUT_PATH}")
-        
+        ids, columns = read_expression_header(input_path)
     except FileNotFoundError:
-        logging.error(f"FATAL: Could not find {INPUT_PATH}. Please re-download data from GDC if you lost this file.")
+        logging.error(f"FATAL: Could not find {input_path}. Please re-download data from GDC if you lost this file.")
+        return
+
+    logging.info("Normalizing IDs...")
+    out_ids, out_pos, colliding = plan_rows(ids)
+    n_single = int((~colliding).sum())
+    n_groups = len(out_ids) - n_single
+    # Chỉ các ID bị trùng mới cần giữ tổng + số giá trị (trung bình bỏ NaN, như groupby().mean())
+    sums = np.zeros((n_groups, len(columns)))
+    counts = np.zeros((n_groups, len(columns)), dtype=np.int64)
+
+    write_tsv = output_format in ('tsv', 'both')
+    # Store cũ phải được cập nhật cùng TSV, nếu không sẽ bị coi là cũ hơn TSV
+    write_bin = output_format in ('store', 'both') or os.path.exists(store_path_for(input_path))
+    tsv_tmp = output_path + '.tmp'
+    store = None
+    try:
+        store = StoreWriter(store_path_for(output_path), out_ids, columns, index_name=ids.name) if write_bin else None
+        with ins.phase('stream_rows'), open(tsv_tmp if write_tsv else os.devnull, 'w', newline='') as out:
+            if write_tsv:
+                pd.DataFrame(columns=columns, index=pd.Index([], name=ids.name)).to_csv(out, sep='\t')
+            start = 0
+            for chunk in iter_expression_chunks(input_path, chunk_rows):
+                values = chunk.to_numpy()
+                if not np.issubdtype(values.dtype, np.floating): # TSV toàn số nguyên -> trung bình vẫn là số thực
+                    values = values.astype(np.float64)
+                pos, hit = out_pos[start:start + len(chunk)], colliding[start:start + len(chunk)]
+                start += len(chunk)
+
+                if (~hit).any(): # Dòng không trùng: ghi thẳng ra (vị trí output liên tiếp)
+                    if write_tsv:
+                        pd.DataFrame(values[~hit], index=out_ids[pos[~hit]], columns=columns).to_csv(out, sep='\t', header=False)
+                    if store is not None:
+                        store.write(pos[~hit][0], values[~hit])
+                if hit.any():
+                    group = pos[hit] - n_single
+                    present = ~np.isnan(values[hit])
+                    np.add.at(sums, group, np.where(present, values[hit], 0.0))
+                    np.add.at(counts, group, present)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = np.where(counts > 0, sums / counts, np.nan) # float64 (store tự ép về float32)
+            if n_groups:
+                if write_tsv:
+                    pd.DataFrame(means, index=out_ids[n_single:], columns=columns).to_csv(out, sep='\t', header=False)
+                if store is not None:
+                    store.write(n_single, means)
+
+        if write_tsv:
+            os.replace(tsv_tmp, output_path)
+        if store is not None:
+            store.close() # Sau TSV -> store không cũ hơn TSV
+    except Exception as e:
+        if os.path.exists(tsv_tmp):
+            os.remove(tsv_tmp)
+        if store is not None:
+            store.discard()
+        ins.error('quick_fix', e)
+        logging.error(f"Quick fix failed, {output_path} left unchanged: {e}")
+        return
+
+    ins.rows_in('mirnas', len(ids)); ins.rows_out('mirnas', len(out_ids))
+    ins.drop('mirnas', 'merged_duplicate_id', len(ids) - len(out_ids))
+    logging.info(f"Done. Reduced from {len(ids)} to {len(out_ids)} unique miRNAs ({n_groups} merged IDs).")
+    logging.info(f"Saved fixed matrix to {output_path if write_tsv else store_path_for(output_path)}")
 
 if __name__ == "__main__":
-    fix_existing_matrix()
\ No newline at end of file
+    with ins.stage('quick_fix'):
+        fix_existing_matrix()
\ No newline at end of file
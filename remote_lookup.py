@@ -0,0 +1,266 @@
+# scripts/remote_lookup.py
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from tqdm import tqdm
+
+from gene_resolver import ensembl_from_hits, expect_equal, RemoteLookupError
+import instrumentation as ins
+
+# --- CẤU HÌNH ---
+MYGENE_URL = 'https://mygene.info/v3' # Đổi sang URL của fake server khi test / benchmark
+BATCH_SIZE = 1000          # Symbol mỗi request (MyGene nhận tối đa 1000)
+MAX_IN_FLIGHT = 4          # Số request chạy đồng thời
+REQUESTS_PER_SECOND = 5.0  # Trần tốc độ gửi request (0 = không giới hạn)
+MAX_RETRIES = 4            # Số lần thử lại mỗi lô
+BACKOFF_SECONDS = 1.0      # Chờ trước lần thử lại thứ k: BACKOFF_SECONDS * 2^k (+ jitter)
+REQUEST_TIMEOUT = 60.0
+CHECKPOINT_PATH = 'data/cache/mygene_checkpoint.jsonl' # Kết quả từng lô xong -> chạy lại chỉ hỏi phần còn thiếu
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.getLogger('httpx').setLevel(logging.WARNING) # Không log từng request
+
+# --- CLIENT ---
+# Client chỉ cần `async query(symbols) -> {symbol: ensembl_id hoặc None}` (mọi symbol của lô)
+# và dùng được với `async with` (mở / đóng kết nối).
+
+class LookupClient:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def query(self, symbols):
+        raise NotImplementedError
+
+class MyGeneClient(LookupClient):
+    """POST /query của MyGene.info (batch query), base_url đổi được -> fake server."""
+    def __init__(self, base_url=MYGENE_URL, scopes='symbol,alias,prev_symbol,reporter', species='human', timeout=REQUEST_TIMEOUT):
+        self.base_url = base_url
+        self.scopes = scopes
+        self.species = species
+        self.timeout = timeout
+        self._http = None
+
+    async def __aenter__(self):
+        import httpx # Chỉ cần khi thực sự phải gọi mạng
+        self._http = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._http.aclose()
+        return False
+
+    async def query(self, symbols):
+        response = await self._http.post('/query', data={'q': ','.join(symbols), 'scopes': self.scopes,
+                                                          'fields': 'ensembl.gene', 'species': self.species})
+        response.raise_for_status()
+        found = ensembl_from_hits(response.json())
+        return {s: found.get(s) for s in symbols}
+
+class StaticClient(LookupClient):
+    """Client trong process từ một dict (self-check không cần mạng), giả lập độ trễ + lỗi ngẫu nhiên."""
+    def __init__(self, mapping=None, latency=0.0, failure_rate=0.0, seed=0):
+        self.mapping = dict(mapping or {})
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+
+    async def query(self, symbols):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self.rng.random() < self.failure_rate:
+            raise ConnectionError("simulated failure")
+        return {s: self.mapping.get(s) for s in symbols}
+
+# --- BACKEND (dùng làm remote của GeneSymbolResolver) ---
+
+class AsyncBatchBackend:
+    """
+    lookup(symbols) cho GeneSymbolResolver: chia lô BATCH_SIZE, tối đa MAX_IN_FLIGHT request cùng lúc,
+    giới hạn REQUESTS_PER_SECOND, thử lại với backoff lũy thừa.
+    Mỗi lô xong được ghi thêm vào checkpoint (JSON lines) -> run bị ngắt chạy lại chỉ hỏi các symbol còn thiếu.
+    Lô vẫn lỗi sau MAX_RETRIES -> RemoteLookupError (kèm kết quả các lô đã xong), không bị lưu là "không tìm thấy".
+    """
+    def __init__(self, client=None, batch_size=BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT, requests_per_second=REQUESTS_PER_SECOND,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS, checkpoint_path=CHECKPOINT_PATH):
+        self.client = client if client is not None else MyGeneClient()
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.checkpoint_path = checkpoint_path
+
+    def lookup(self, symbols):
+        return asyncio.run(self.lookup_async(symbols))
+
+    def _load_checkpoint(self):
+        done = {}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # Dòng ghi dở khi bị ngắt
+                        continue
+                    done[record['symbol']] = record['ensembl_id']
+        return done
+
+    async def _throttle(self):
+        if not self.requests_per_second:
+            return
+        loop = asyncio.get_running_loop()
+        async with self._rate_lock:
+            wait = self._next_start - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_start = max(loop.time(), self._next_start) + 1.0 / self.requests_per_second
+
+    async def _query_with_retry(self, client, batch):
+        for attempt in range(self.max_retries + 1):
+            await self._throttle()
+            try:
+                return await client.query(batch)
+            except Exception as e:
+                ins.count('remote_request_errors')
+                if attempt == self.max_retries:
+                    logging.warning(f"Lookup batch of {len(batch)} symbols failed after {attempt + 1} attempts: {e}")
+                    return None
+                delay = self.backoff * 2 ** attempt * (1 + random.random() * 0.5)
+                logging.warning(f"Lookup batch failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def lookup_async(self, symbols):
+        done = self._load_checkpoint()
+        mapping = {s: done[s] for s in symbols if s in done}
+        todo = [s for s in symbols if s not in done]
+        batches = [todo[start:start + self.batch_size] for start in range(0, len(todo), self.batch_size)]
+        logging.info(f"Remote lookup: {len(todo)} symbols in {len(batches)} batches ({len(mapping)} from checkpoint)...")
+        ins.count('remote_checkpoint_hits', len(mapping))
+
+        self._rate_lock = asyncio.Lock()
+        self._next_start = 0.0
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        failed = 0
+        if self.checkpoint_path:
+            os.makedirs(os.path.dirname(self.checkpoint_path) or '.', exist_ok=True)
+        with open(self.checkpoint_path or os.devnull, 'a') as checkpoint, tqdm(total=len(todo), desc="Remote lookup") as progress:
+            async def run(client, batch):
+                nonlocal failed
+                async with semaphore:
+                    found = await self._query_with_retry(client, batch)
+                if found is None:
+                    failed += 1
+                else:
+                    mapping.update(found)
+                    checkpoint.writelines(json.dumps({'symbol': s, 'ensembl_id': e}) + '\n' for s, e in found.items())
+                    checkpoint.flush()
+                progress.update(len(batch))
+
+            async with self.client as client:
+                await asyncio.gather(*(run(client, batch) for batch in batches))
+
+        ins.count('remote_batches', len(batches)); ins.count('remote_batches_failed', failed)
+        if failed:
+            raise RemoteLookupError(f"{failed} of {len(batches)} lookup batches failed; rerun to resume from {self.checkpoint_path}", mapping)
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path) # Xong hết -> resolver lưu kết quả vào index, checkpoint không cần nữa
+        return mapping
+
+# --- FAKE SERVER (test / benchmark) ---
+
+@contextmanager
+def fake_mygene_server(mapping, fail_every=0, latency=0.0):
+    """
+    Server HTTP cục bộ giả lập POST /v3/query của MyGene từ dict symbol -> Ensembl.
+    fail_every = k > 0: request thứ k, 2k, ... trả 503 (kiểm tra retry). Trả về base_url.
+    """
+    state = {'requests': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            with lock:
+                state['requests'] += 1
+                fail = fail_every and state['requests'] % fail_every == 0
+            if latency:
+                threading.Event().wait(latency)
+            form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+            if fail or self.path.rstrip('/') != '/v3/query':
+                self.send_response(503 if fail else 404)
+                self.end_headers()
+                return
+            hits = [{'query': s, 'ensembl': {'gene': mapping[s]}} if mapping.get(s) else {'query': s, 'notfound': True}
+                    for s in form.get('q', [''])[0].split(',') if s]
+            body = json.dumps(hits).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/v3"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def self_check():
+    """
+    Kiểm tra AsyncBatchBackend không cần mạng (checkpoint trong thư mục tạm):
+    lô lỗi -> RemoteLookupError kèm phần đã xong, chạy lại chỉ hỏi phần thiếu rồi xóa checkpoint;
+    503 từ fake server -> thử lại đến khi đủ kết quả.
+    """
+    import tempfile
+    mapping = {f'GENE{i}': (f'ENSG{i:011d}' if i % 3 else None) for i in range(40)}
+    symbols = list(mapping)
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint_path = os.path.join(tmp, 'checkpoint.jsonl')
+        options = dict(batch_size=4, max_in_flight=2, requests_per_second=0, backoff=0, checkpoint_path=checkpoint_path)
+
+        # Một phần lô lỗi (không thử lại) -> lỗi, nhưng các lô xong nằm trong e.found + checkpoint
+        flaky = StaticClient(mapping, failure_rate=0.5, seed=1)
+        try:
+            AsyncBatchBackend(flaky, max_retries=0, **options).lookup(symbols)
+            raise RuntimeError("Self-check failed: lookup with failing batches did not raise RemoteLookupError")
+        except RemoteLookupError as e:
+            found = e.found
+        expect_equal("partial results", found, {s: mapping[s] for s in found})
+        if not 0 < len(found) < len(symbols):
+            raise RuntimeError(f"Self-check failed: expected a partial failure, got {len(found)} of {len(symbols)} symbols")
+        expect_equal("checkpoint after failure", AsyncBatchBackend(checkpoint_path=checkpoint_path)._load_checkpoint(), found)
+
+        # Chạy lại: chỉ hỏi các symbol còn thiếu, kết quả đủ, checkpoint bị xóa
+        resumed = StaticClient(mapping)
+        expect_equal("resumed lookup", AsyncBatchBackend(resumed, **options).lookup(symbols), mapping)
+        missing = len(symbols) - len(found)
+        expect_equal("requests on resume", resumed.requests, (missing + options['batch_size'] - 1) // options['batch_size'])
+        expect_equal("checkpoint removed", os.path.exists(checkpoint_path), False)
+
+        # HTTP thật tới fake server, mỗi request thứ 2 trả 503 -> retry (tuần tự: lần thử lại luôn rơi vào request lẻ)
+        with fake_mygene_server(mapping, fail_every=2) as url:
+            backend = AsyncBatchBackend(MyGeneClient(base_url=url), max_retries=1, **dict(options, max_in_flight=1))
+            expect_equal("lookup with retries", backend.lookup(symbols), mapping)
+    logging.info("Remote lookup self-check passed.")
+
+if __name__ == "__main__":
+    # python remote_lookup.py --self-check -> kiểm tra thử lại / checkpoint với client cục bộ + fake server
+    if sys.argv[1:] == ['--self-check']:
+        self_check()
\ No newline at end of file
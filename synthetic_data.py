@@ -0,0 +1,175 @@
+# scripts/synthetic_data.py
+import numpy as np
+import pandas as pd
+import os
+import sys
+import json
+import uuid
+import hashlib
+import logging
+
+# --- CẤU HÌNH ---
+# Kích thước dữ liệu giả lập. 'tcga' ~ một cohort TCGA đầy đủ.
+PRESETS = {
+    'tiny':   dict(n_patients=40,    n_genes=300,   n_mirnas=60,   dup_file_rate=0.1,  n_mirtarbase=3000,    n_targetscan=20000,    n_families=40),
+    'small':  dict(n_patients=300,   n_genes=2000,  n_mirnas=300,  dup_file_rate=0.05, n_mirtarbase=30000,   n_targetscan=300000,   n_families=150),
+    'medium': dict(n_patients=1500,  n_genes=8000,  n_mirnas=900,  dup_file_rate=0.05, n_mirtarbase=150000,  n_targetscan=2000000,  n_families=400),
+    'tcga':   dict(n_patients=10000, n_genes=20000, n_mirnas=1800, dup_file_rate=0.03, n_mirtarbase=500000,  n_targetscan=12000000, n_families=900),
+}
+SIGNAL_FRACTION = 0.05 # Tỉ lệ cặp ứng viên được gắn tương quan nghịch thật
+OTHER_SPECIES = [10090, 9598, 10116] # Dòng TargetScan / miRTarBase không phải người
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def _precursor_ids(n_mirnas, rng):
+    """ID kiểu GDC: hsa-mir-21, hsa-mir-199a-1, hsa-let-7a-2 ..."""
+    ids, number = [], 100
+    while len(ids) < n_mirnas:
+        if len(ids) % 25 == 0 and len(ids) // 25 < 7:
+            letter = 'abcdefg'[len(ids) // 25]
+            ids.extend(f'hsa-let-7{letter}-{copy}' for copy in (1, 2))
+            continue
+        suffix = rng.choice(['', 'a', 'b'], p=[0.3, 0.5, 0.2])
+        copies = rng.choice([0, 1, 2], p=[0.8, 0.1, 0.1])
+        if copies:
+            ids.extend(f'hsa-mir-{number}{suffix}-{copy}' for copy in range(1, copies + 2))
+        else:
+            ids.append(f'hsa-mir-{number}{suffix}')
+        number += 1
+    return list(dict.fromkeys(ids))[:n_mirnas]
+
+def _mature_id(precursor_id, arm):
+    """hsa-mir-199a-1 -> hsa-miR-199a-5p (bỏ số bản sao, thêm arm)."""
+    parts = precursor_id.replace('mir', 'miR').split('-')
+    if parts[-1].isdigit() and len(parts) > 3:
+        parts = parts[:-1]
+    return '-'.join(parts) + f'-{arm}'
+
+def _barcode(i):
+    return f'TCGA-{chr(65 + i // 2600 % 26)}{chr(65 + i // 100 % 26)}-{i % 10000:04d}'
+
+def write_gdc_files(root, precursors, mirna_expr, patients, dup_file_rate, rng):
+    """miRNA_expression/: MANIFEST.txt, METADATA.json và một file quantification cho mỗi mẫu."""
+    data_dir = os.path.join(root, 'miRNA_expression')
+    os.makedirs(data_dir, exist_ok=True)
+    samples = list(range(len(patients))) + list(rng.choice(len(patients), int(len(patients) * dup_file_rate)))
+
+    manifest, metadata = [], []
+    for k, p in enumerate(samples):
+        file_id = str(uuid.UUID(int=(int(rng.integers(0, 2 ** 63)) << 64) | k))
+        file_name = f'{file_id[:8]}-{k}.mirbase21.mirnas.quantification.txt'
+        rel_path = os.path.join(file_id, file_name)
+        rpm = mirna_expr[:, p] * rng.lognormal(0, 0.05, len(precursors)) # Lặp kỹ thuật: thêm chút nhiễu
+        quant = pd.DataFrame({
+            'miRNA_ID': precursors,
+            'read_count': np.round(rpm * 3).astype(np.int64),
+            'reads_per_million_miRNA_mapped': np.round(rpm, 6),
+            'cross-mapped': 'N',
+        })
+        os.makedirs(os.path.join(data_dir, file_id), exist_ok=True)
+        text = quant.to_csv(sep='\t', index=False).encode('utf-8')
+        with open(os.path.join(data_dir, rel_path), 'wb') as f:
+            f.write(text)
+        manifest.append({'id': file_id, 'filename': rel_path, 'md5': hashlib.md5(text).hexdigest(), 'size': len(text), 'state': 'released'})
+        metadata.append({'file_name': file_name, 'file_id': file_id,
+                         'associated_entities': [{'entity_submitter_id': f'{patients[p]}-01A-11R-A{k % 1000:03d}-13',
+                                                  'entity_type': 'aliquot'}]})
+
+    pd.DataFrame(manifest).to_csv(os.path.join(data_dir, 'MANIFEST.txt'), sep='\t', index=False)
+    with open(os.path.join(data_dir, 'METADATA.json'), 'w') as f:
+        json.dump(metadata, f)
+
+def write_interactions(root, matures, genes, n_mirtarbase, n_targetscan, n_families, rng):
+    """data/raw/: hsa_MTI_homo.csv, miR_Family_Info.txt, Predicted_Targets_Info.txt."""
+    raw_dir = os.path.join(root, 'data', 'raw')
+    os.makedirs(raw_dir, exist_ok=True)
+
+    other = rng.random(n_mirtarbase) < 0.1
+    mti_mirna = rng.choice(matures, n_mirtarbase)
+    mti_mirna = np.where(other, np.char.replace(mti_mirna.astype(str), 'hsa-', 'mmu-'), mti_mirna)
+    pd.DataFrame({
+        'miRTarBase ID': [f'MIRT{i:06d}' for i in range(n_mirtarbase)],
+        'miRNA': mti_mirna,
+        'Species (miRNA)': np.where(other, 'mmu', 'hsa'),
+        'Target Gene': rng.choice(genes, n_mirtarbase),
+        'Target Gene (Entrez ID)': rng.integers(1, 100000, n_mirtarbase),
+        'Species (Target Gene)': np.where(other, 'mmu', 'hsa'),
+        'Experiments': 'Luciferase reporter assay',
+        'Support Type': rng.choice(['Functional MTI', 'Functional MTI (Weak)'], n_mirtarbase),
+        'References (PMID)': rng.integers(10000000, 30000000, n_mirtarbase),
+    }).to_csv(os.path.join(raw_dir, 'hsa_MTI_homo.csv'), index=False)
+
+    # Họ miRNA: mỗi mature người thuộc một họ (theo seed), kèm thành viên chuột
+    family_names = [f'miR-{100 + i}-5p' for i in range(n_families)]
+    member_family = rng.integers(0, n_families, len(matures))
+    fam_rows = [{'miR family': family_names[f], 'Seed+m8': 'AGCUUAU', 'Species ID': 9606, 'MiRBase ID': m,
+                 'Mature sequence': 'UAGCUUAUCAGACUGAUGUUGA', 'Family Conservation?': 2, 'MiRBase Accession': f'MIMAT{i:07d}'}
+                for i, (m, f) in enumerate(zip(matures, member_family))]
+    fam_rows += [{**row, 'Species ID': 10090, 'MiRBase ID': row['MiRBase ID'].replace('hsa-', 'mmu-')} for row in fam_rows[::3]]
+    pd.DataFrame(fam_rows).to_csv(os.path.join(raw_dir, 'miR_Family_Info.txt'), sep='\t', index=False)
+
+    # Một số họ không có trong file họ -> kiểm tra luật fallback 'hsa-'
+    ts_families = np.array(family_names + ['miR-9999-3p', 'let-7-5p/98-5p'])
+    pd.DataFrame({
+        'miR Family': rng.choice(ts_families, n_targetscan),
+        'Gene ID': 'ENSG00000000000.1',
+        'Gene Symbol': rng.choice(genes, n_targetscan),
+        'Transcript ID': 'ENST00000000000.1',
+        'Species ID': np.where(rng.random(n_targetscan) < 0.6, 9606, rng.choice(OTHER_SPECIES, n_targetscan)),
+        'UTR start': rng.integers(1, 3000, n_targetscan),
+        'UTR end': rng.integers(3000, 6000, n_targetscan),
+        'MSA start': 1, 'MSA end': 8,
+        'Seed match': rng.choice(['8mer', '7mer-m8', '7mer-1a'], n_targetscan),
+        'PCT': np.round(rng.random(n_targetscan), 3),
+    }).to_csv(os.path.join(raw_dir, 'Predicted_Targets_Info.txt'), sep='\t', index=False)
+
+    return mti_mirna[~other], member_family
+
+def write_hgnc_dump(root, genes, rng):
+    """data/raw/hgnc_complete_set.txt: symbol + alias + tên cũ -> Ensembl (cho resolver offline)."""
+    n = len(genes)
+    alias = np.where(rng.random(n) < 0.3, [f'{g}-AS' for g in genes], '')
+    prev = np.where(rng.random(n) < 0.1, [f'OLD{g}' for g in genes], '')
+    ensembl = np.where(rng.random(n) < 0.98, [f'ENSG{i + 1:011d}' for i in range(n)], '')
+    pd.DataFrame({'hgnc_id': [f'HGNC:{i + 1}' for i in range(n)], 'symbol': genes, 'alias_symbol': alias,
+                  'prev_symbol': prev, 'ensembl_gene_id': ensembl}
+                 ).to_csv(os.path.join(root, 'data', 'raw', 'hgnc_complete_set.txt'), sep='\t', index=False)
+
+def generate(root, n_patients, n_genes, n_mirnas, dup_file_rate, n_mirtarbase, n_targetscan, n_families, seed=0):
+    """Sinh toàn bộ đầu vào của pipeline dưới root/ theo đúng đường dẫn mặc định của các script."""
+    rng = np.random.default_rng(seed)
+    logging.info(f"Generating synthetic data in {root}: {n_patients} patients, {n_genes} genes, {n_mirnas} miRNAs...")
+
+    patients = [_barcode(i) for i in range(n_patients)]
+    precursors = _precursor_ids(n_mirnas, rng)
+    matures = list(dict.fromkeys(_mature_id(p, arm) for p in precursors for arm in ('5p', '3p')))
+    genes = [f'GENE{i}' for i in range(n_genes)]
+
+    # Biểu hiện miRNA: log-normal, ~20% giá trị bằng 0 (dữ liệu RPM thưa)
+    log_mirna = rng.normal(2, 1.5, (n_mirnas, n_patients))
+    mirna_expr = np.exp(log_mirna) * (rng.random((n_mirnas, n_patients)) > 0.2)
+
+    validated, _ = write_interactions(root, matures, genes, n_mirtarbase, n_targetscan, n_families, rng)
+
+    # Biểu hiện gene: nhiễu + tương quan nghịch thật cho một phần cặp validated
+    log_gene = rng.normal(5, 1, (n_genes, n_patients))
+    n_signal = int(len(validated) * SIGNAL_FRACTION)
+    mature_to_pre = {_mature_id(p, arm): i for i, p in enumerate(precursors) for arm in ('5p', '3p')}
+    for mirna_id in rng.choice(validated, n_signal):
+        g = rng.integers(0, n_genes)
+        log_gene[g] -= 0.3 * (log_mirna[mature_to_pre[mirna_id]] - 2)
+    gene_df = pd.DataFrame(np.round(np.exp(log_gene), 4), index=pd.Index(genes, name='Hugo_Symbol'),
+                           columns=[f'{p}-01' for p in patients])
+    gene_df.insert(0, 'Entrez_Gene_Id', np.arange(1, n_genes + 1))
+    features_dir = os.path.join(root, 'data', 'features')
+    os.makedirs(features_dir, exist_ok=True)
+    gene_df.to_csv(os.path.join(features_dir, 'genes_expr.txt'), sep='\t')
+    del gene_df, log_gene
+
+    write_gdc_files(root, precursors, mirna_expr, patients, dup_file_rate, rng)
+    write_hgnc_dump(root, genes, rng)
+    logging.info("Synthetic data ready.")
+
+if __name__ == "__main__":
+    # python synthetic_data.py <thư mục> [preset]
+    generate(sys.argv[1], **PRESETS[sys.argv[2] if len(sys.argv) > 2 else 'small'])